@@ -1,20 +1,841 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-"""This module contains the class BibTeX."""
+"""This module contains the class BibTeX.
+
+Modules only needed by some commands (argparse, json, multiprocessing,
+citation styles, help text, writers etc.) are imported when used, which
+keeps the start-up time of short runs low.
+"""
+import sys
+
+if __name__ == "__main__":
+    # run main() of the imported (compiled) module rather than this script,
+    # so the module is executed once and helper modules importing BibtXt
+    # share its state (e.g. registered styles):
+    import BibtXt
+    sys.exit(BibtXt.main())
+
+import contextlib
+import functools
 import io
 import os
 import re
-import sys
 import time
+import unicodedata
+from collections import Counter
 from datetime import date
 
-from data.entry_types import entry_types
 from data.entry_types import types
 from data.entry_types import fields
+from data.entry_types import required
+from data.entry_types import macros
 
 no_author = "n.a."
 no_title = "n.a."
 no_year = "n.d."
+# entries of .bib file shared with worker processes of render_files():
+shared_entries = None
+# compiled_styles: {name: {type: [(placeholders, template) etc.]}}
+compiled_styles = {}
+# instance of instrument.Profiler if stages are recorded (cf. main()):
+profiler = None
+
+
+chunk_size = 1 << 16
+# increase whenever output of iter_entries() changes (invalidates caches):
+parser_version = 3
+# fields holding names, whose braces are kept for parse_names():
+name_fields = {"author", "editor"}
+name_separator = u" and "
+name_cache_size = 1 << 16
+# locale of collation_key() (None: Unicode-aware collation, cf.
+# set_collation()) and its transformation of strings (locale.strxfrm):
+collation_locale = None
+collation_transform = None
+# LaTeX accents (e.g. \"u) and their combining characters:
+latex_accents = {u"\"": u"\u0308", u"'": u"\u0301", u"`": u"\u0300",
+                 u"^": u"\u0302", u"~": u"\u0303", u"=": u"\u0304",
+                 u".": u"\u0307"}
+# accented letter (\"u) or other LaTeX command (\ss):
+re_latex = re.compile(r"\\(?:([\"'`^~=.])\s*(\w)|([a-zA-Z]*)\s*)")
+# entry types without key and fields:
+skipped_types = {"comment"}
+# entry types yielded with key "" by iter_entries() (cf. parse_macros()):
+macro_types = {"string", "preamble"}
+# encloses names of @string macros in raw values, e.g. "\x00jan\x00 2000":
+macro_mark = u"\x00"
+brace_table = {ord("{"): None, ord("}"): None}
+# canonical (interned) strings of field names and entry types:
+field_names = {sys.intern(field): sys.intern(field) for field in fields}
+type_names = {sys.intern(mytype): sys.intern(mytype) for mytype in types}
+re_entry_start = re.compile(r"@\s*(\w+)\s*([{(])")
+re_delimiter = re.compile(r"[{}()]")
+re_brace = re.compile(r"[{}]")
+re_quote = re.compile(r"[{}\"]")
+re_field_name = re.compile(r"[\s,]*([^\s=,{}\"#]+)\s*=\s*")
+re_bare = re.compile(r"[^\s,#{}\"]+")
+re_concat = re.compile(r"\s*(#?)\s*")
+# words and commas of names without braces (cf. split_words()):
+re_name_word = re.compile(r"[^\s,~]+|,")
+# \cite[x][y]{z}, \cite[x]{z} and \cite{z}:
+re_cite = re.compile(r"\\cite(?:\[([^[\]]*)\])?(?:\[([^[\]]*)\])?{(\w+)}")
+# beginning of a \cite command which is cut off by the end of the text:
+re_cite_start = re.compile(r"\\(?:c(?:i(?:t(?:e(?:\[[^[\]]*(?:\](?:\[[^[\]]*"
+                           r"(?:\](?:\{\w*)?)?|\{\w*)?)?|\{\w*)?)?)?)?)?\Z")
+# longest beginning of a \cite command kept back by iter_txt():
+max_pending = 1 << 20
+
+
+class BibTeXError(ValueError):
+    """Error in .txt or .bib file (or citation style).
+
+    The command line reports it and exits with status 1 (cf. run(),
+    render_pairs()); code embedding Bib.tXt (e.g. server.py) catches it
+    like any other exception.
+    """
+
+
+def quote_all(keys):
+    """Return keys in single quotes separated by commas."""
+    return ", ".join("\'{}\'".format(key) for key in keys)
+
+
+def register_style(name, templates):
+    """Compile citation style and register it under name.
+
+    templates -- dict of entry types and lists of templates (cf.
+    data/styles.py); missing types are taken from the default style
+    """
+    import string
+    from data.styles import styles
+    if not isinstance(templates, dict):
+        raise BibTeXError("Error: The citation style \'{}\' must map entry "
+                          "types to lists of templates.".format(name))
+    for mytype, value in templates.items():
+        if (not isinstance(value, list)
+           or not all(isinstance(template, str) for template in value)):
+            raise BibTeXError("Error: The templates of \'{}\' in citation "
+                              "style \'{}\' must be a list of strings."
+                              .format(mytype, name))
+    merged = dict(styles["default"])
+    merged.update((mytype.lower(), value)
+                  for mytype, value in templates.items())
+    formatter = string.Formatter()
+    compiled_styles[name] = {
+        mytype: [(frozenset(field for _, field, _, _
+                            in formatter.parse(template) if field), template)
+                 for template in value]
+        for mytype, value in merged.items()}
+
+
+def load_style(path):
+    """Register citation style of .json file and return its name.
+
+    The name is the file name without extension.
+    """
+    import json
+    with io.open(path, encoding="utf-8") as file:
+        templates = json.load(file)
+    name = os.path.splitext(os.path.basename(path))[0]
+    register_style(name, templates)
+    return name
+
+
+def get_style(name):
+    """Return compiled citation style. Exit if style is not known."""
+    if name not in compiled_styles:
+        from data.styles import styles
+        if name not in styles:
+            raise BibTeXError("Error: \'{}\' is not a known citation "
+                              "style.".format(name))
+        register_style(name, styles[name])
+    return compiled_styles[name]
+
+
+def format_entry(templates, values):
+    """Return first template whose fields are all in values, formatted.
+
+    Return None if no template fits.
+
+    templates -- list of (needed fields, template) of a compiled style
+    values -- dict of placeholders (cf. template_values())
+    """
+    for needed, template in templates:
+        if needed.issubset(values):
+            return template.format_map(values)
+    return None
+
+
+def template_values(entry):
+    """Return dict of placeholders of templates for instance of Entry."""
+    values = {"title": no_title}
+    values.update(entry.fields)
+    values["surname"] = entry.author.surname
+    values["editor"] = format_names(entry.editors) or no_author
+    if entry.authors:
+        values["forename"] = entry.author.forename
+        values["authors"] = values["author"] = format_names(entry.authors)
+    else:
+        values.pop("author", None)
+    return values
+
+
+def iter_citations(txt):
+    """Yield (start, end, prefix, suffix, key) for every \\cite command.
+
+    prefix is None if the command has less than two pairs of brackets;
+    a single pair holds the suffix (e.g. the page). suffix is "" if not
+    given.
+    """
+    for match in re_cite.finditer(txt):
+        first, second, key = match.groups()
+        if second is None:
+            yield match.start(), match.end(), None, first or u"", key
+        else:
+            yield match.start(), match.end(), first, second, key
+
+
+def iter_txt(txt, size=chunk_size):
+    """Yield (text, citations) for consecutive pieces of a .txt file.
+
+    The file is read in chunks of size characters. A \\cite command cut
+    off by the end of a chunk is kept back for the next piece, so pieces
+    never split a command. citations are the records of iter_citations()
+    relative to text.
+
+    txt -- file object of .txt file
+    size -- number of characters read at once (default chunk_size)
+    """
+    buffer = u""
+    while True:
+        chunk = txt.read(size)
+        buffer += chunk
+        if not chunk:
+            yield buffer, list(iter_citations(buffer))
+            return
+        citations = list(iter_citations(buffer))
+        cut = citations[-1][1] if citations else 0
+        pending = re_cite_start.search(buffer, cut)
+        if pending is not None and len(buffer) - pending.start() < max_pending:
+            cut = pending.start()
+        else:
+            cut = len(buffer)
+        yield buffer[:cut], citations
+        buffer = buffer[cut:]
+
+
+def iter_entries(bib, size=chunk_size, strict=False):
+    """Tokenize .bib file and yield (type, key, fields) for every entry.
+
+    The file is read in chunks of size characters and only the current
+    entry is held in memory. Entries are delimited by balanced braces
+    (or parentheses), so values may span several lines. fields is a dict
+    of lower-case field names and cleaned values; values referring to
+    @string macros are kept raw (cf. BibTeX.expand()). @comment is
+    skipped; @string and @preamble are yielded with key "" and the fields
+    of parse_macros().
+
+    bib -- content of .bib file or file object
+    size -- number of characters read at once (default chunk_size)
+    strict -- raise ValueError if the last entry is not terminated
+    (default False, i.e. it ends with the file)
+    """
+    if isinstance(bib, str):
+        bib = io.StringIO(bib)
+    buffer, offset, eof = "", 0, False
+    while True:
+        match = re_entry_start.search(buffer, offset)
+        if match is None:
+            if eof:
+                return
+            # keep tail which might contain the beginning of an entry:
+            buffer = buffer[max(offset, len(buffer) - 256):]
+            offset = 0
+            chunk = bib.read(size)
+            eof = not chunk
+            buffer += chunk
+            continue
+        closing = "}" if match.group(2) == "{" else ")"
+        start = pos = match.end()
+        depth, end = 0, None
+        while end is None:
+            for delimiter in re_delimiter.finditer(buffer, pos):
+                char = delimiter.group()
+                if char == "{":
+                    depth += 1
+                elif char == "}" and depth:
+                    depth -= 1
+                elif char == closing and not depth:
+                    end = delimiter.start()
+                    break
+            else:
+                if eof:
+                    if strict:
+                        raise ValueError("unterminated entry")
+                    # unterminated entry:
+                    end = len(buffer)
+                    break
+                buffer = buffer[start:]
+                start, pos = 0, len(buffer)
+                chunk = bib.read(size)
+                eof = not chunk
+                buffer += chunk
+        offset = end + 1
+        mytype = match.group(1).lower()
+        if mytype in skipped_types:
+            continue
+        if mytype in macro_types:
+            yield match.group(1), u"", parse_macros(mytype,
+                                                    buffer[start:end])
+            continue
+        key, field_dict = parse_body(buffer[start:end])
+        yield match.group(1), key, field_dict
+
+
+def parse_entries(bib, cache=None, jobs=1):
+    """Return list of all entries of .bib file.
+
+    With more than one job, large .bib files are parsed in shards by a
+    pool of worker processes (cf. shards.py); the result is the same.
+
+    bib -- content of .bib file or file object
+    cache -- instance of cache.BibCache (default None)
+    jobs -- number of worker processes (default 1)
+    """
+    if cache is not None:
+        digest = cache.digest(bib, parser_version)
+        entries = cache.get(digest)
+        if entries is None:
+            entries = parse_entries(bib, None, jobs)
+            cache.put(digest, entries)
+        return entries
+    if jobs > 1 and hasattr(bib, "name") and hasattr(bib, "seek"):
+        from shards import parse_parallel
+        return parse_parallel(bib.name, jobs)
+    return list(iter_entries(bib))
+
+
+def parse_body(body):
+    """Return key and dict of fields of an entry.
+
+    body -- text between the delimiters of an entry ("key, field = value")
+    """
+    key, _, rest = body.partition(",")
+    return key.strip(), parse_fields(rest)
+
+
+def parse_fields(text, known=True):
+    """Return dict of fields of text ("field = value, ...").
+
+    Values referring to macros are kept raw, others are cleaned.
+
+    known -- keep known fields only and clean values (default True);
+    otherwise all (lower-case) names and raw values are kept
+    """
+    field_dict = {}
+    pos, length = 0, len(text)
+    while pos < length:
+        match = re_field_name.match(text, pos)
+        if match is None:
+            # skip malformed field:
+            comma = text.find(",", pos + 1)
+            if comma == -1:
+                break
+            pos = comma
+            continue
+        value, pos = read_value(text, match.end())
+        if not known:
+            field_dict[sys.intern(match.group(1).lower())] = value
+            continue
+        name = field_names.get(match.group(1).lower())
+        if name is None:
+            continue
+        if macro_mark in value:
+            field_dict[name] = value
+        else:
+            field_dict[name] = clean_value(value, name in name_fields)
+    return field_dict
+
+
+def parse_macros(mytype, body):
+    """Return dict of raw values of @string or @preamble entry.
+
+    @string yields {name: value}, @preamble {"preamble": value}.
+
+    mytype -- "string" or "preamble"
+    body -- text between the delimiters of the entry
+    """
+    if mytype == "string":
+        return parse_fields(body, known=False)
+    start = len(body) - len(body.lstrip())
+    return {"preamble": read_value(body, start)[0]}
+
+
+def read_value(text, pos):
+    """Return raw value starting at pos and position after it.
+
+    Braced, quoted and bare parts joined by '#' are concatenated. Bare
+    parts other than numbers are names of macros and enclosed in
+    macro_mark.
+    """
+    parts = []
+    while True:
+        char = text[pos:pos + 1]
+        if char == "{":
+            end = closing_brace(text, pos)
+            parts.append(text[pos + 1:end])
+        elif char == "\"":
+            end = closing_quote(text, pos)
+            parts.append(text[pos + 1:end])
+        else:
+            match = re_bare.match(text, pos)
+            if match is None:
+                break
+            end = match.end() - 1
+            if match.group().isdigit():
+                parts.append(match.group())
+            else:
+                parts.append(macro_mark + match.group() + macro_mark)
+        match = re_concat.match(text, end + 1)
+        pos = match.end()
+        if not match.group(1):
+            break
+    comma = text.find(",", pos)
+    return "".join(parts), len(text) if comma == -1 else comma + 1
+
+
+def closing_brace(text, pos):
+    """Return position of brace closing the one at pos."""
+    depth = 0
+    for match in re_brace.finditer(text, pos):
+        depth += 1 if match.group() == "{" else -1
+        if not depth:
+            return match.start()
+    return len(text)
+
+
+def closing_quote(text, pos):
+    """Return position of quote closing the one at pos."""
+    depth = 0
+    for match in re_quote.finditer(text, pos + 1):
+        char = match.group()
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+        elif not depth:
+            return match.start()
+    return len(text)
+
+
+def clean_value(value, keep_braces=False):
+    """Return value without braces, surplus whitespace and final punctuation.
+
+    Comma after digit and full stop after title etc. are removed.
+
+    value -- raw value
+    keep_braces -- keep braces, e.g. of names (default False)
+    """
+    if not keep_braces:
+        value = value.translate(brace_table)
+    value = " ".join(value.split())
+    if value.endswith((",", ".")):
+        value = value[:-1]
+    return value
+
+
+class Person(object):
+    """Name of an author or editor.
+
+    Parts of the name as in BibTeX: first, von, last and jr. The sort key
+    is computed once (cf. person_key()).
+    """
+
+    __slots__ = ("last", "first", "von", "jr", "collation")
+
+    def __init__(self, last, first=u"", von=u"", jr=u""):
+        """Initialize an instance of the class.
+
+        last -- last name
+        first -- first name(s) (default "")
+        von -- von part, e.g. "van der" (default "")
+        jr -- jr part, e.g. "Jr." (default "")
+        """
+        self.last = last
+        self.first = first
+        self.von = von
+        self.jr = jr
+        # (locale, key) of person_key():
+        self.collation = None
+
+    @property
+    def surname(self):
+        """Return last name."""
+        return self.last
+
+    @property
+    def forename(self):
+        """Return first name(s) followed by von and jr part."""
+        forename = u" ".join(part for part in (self.first, self.von) if part)
+        if self.jr:
+            return u"{}, {}".format(forename, self.jr)
+        return forename
+
+    def __str__(self):
+        """Return name as "surname, forename"."""
+        if self.forename:
+            return u"{}, {}".format(self.surname, self.forename)
+        return self.surname
+
+    def __repr__(self):
+        """Return representation of the instance."""
+        return "Person({!r}, {!r}, {!r}, {!r})".format(
+            self.last, self.first, self.von, self.jr)
+
+
+# generated author of entries without author:
+anonymous = Person(no_author)
+
+
+@functools.lru_cache(maxsize=name_cache_size)
+def parse_names(raw):
+    """Return tuple of Person for value of author or editor field.
+
+    Names are separated by 'and' (outside braces) and may be given as
+    "First von Last", "von Last, First" or "von Last, Jr, First". Results
+    are memoized, so instances of Person are shared and must not be
+    changed.
+    """
+    names, words = [], []
+    for word in split_words(raw):
+        if word.lower() == "and":
+            if words:
+                names.append(words)
+            words = []
+        else:
+            words.append(word)
+    if words:
+        names.append(words)
+    return tuple(parse_name(words) for words in names)
+
+
+def split_words(raw):
+    """Return list of words and commas of raw name outside braces."""
+    if "{" not in raw:
+        return re_name_word.findall(raw)
+    words, word, depth = [], [], 0
+    for char in raw:
+        if char == "{":
+            depth += 1
+        elif char == "}" and depth:
+            depth -= 1
+        if not depth and (char.isspace() or char == "," or char == "~"):
+            if word:
+                words.append(u"".join(word))
+                word = []
+            if char == ",":
+                words.append(char)
+        else:
+            word.append(char)
+    if word:
+        words.append(u"".join(word))
+    return words
+
+
+def parse_name(words):
+    """Return Person for list of words and commas of one name."""
+    parts = [[]]
+    for word in words:
+        if word == ",":
+            parts.append([])
+        else:
+            parts[-1].append(word)
+    if len(parts) == 1:
+        # First von Last:
+        rest, last = parts[0][:-1], parts[0][-1:]
+        lower = [index for index, word in enumerate(rest) if is_lower(word)]
+        if lower:
+            first = rest[:lower[0]]
+            von = rest[lower[0]:lower[-1] + 1]
+            last = rest[lower[-1] + 1:] + last
+        else:
+            first, von = rest, []
+        jr = []
+    else:
+        # von Last, First or von Last, Jr, First:
+        von_last, first = parts[0], parts[-1]
+        jr = parts[1] if len(parts) > 2 else []
+        lower = [index for index, word in enumerate(von_last[:-1])
+                 if is_lower(word)]
+        split = lower[-1] + 1 if lower else 0
+        von, last = von_last[:split], von_last[split:]
+    return Person(join_words(last) or no_author, join_words(first),
+                  join_words(von), join_words(jr))
+
+
+def is_lower(word):
+    """Return True if first letter of word outside braces is lower case."""
+    depth = 0
+    for char in word:
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+        elif char.isalpha():
+            return not depth and char.islower()
+    return False
+
+
+def join_words(words):
+    """Return words without braces separated by spaces."""
+    return u" ".join(words).translate(brace_table)
+
+
+def set_collation(name=None):
+    """Sort reference lists with the collation of locale name.
+
+    name -- locale, e.g. "de_DE.UTF-8" (default None, i.e. the
+    Unicode-aware collation of collation_key()); locale.Error is raised if
+    it is not available
+    """
+    global collation_locale, collation_transform
+    if name:
+        import locale
+        locale.setlocale(locale.LC_COLLATE, name)
+        collation_transform = locale.strxfrm
+    else:
+        collation_transform = None
+    collation_locale = name or None
+
+
+def collation_key(text):
+    """Return (primary, secondary) sort key of text.
+
+    Both ignore case (casefold); the primary key also ignores accents, so
+    "Müller" sorts with "Muller" and accents only break ties (cf.
+    sort_key()). LaTeX accents such as \\"u count as accents. With a
+    locale (cf. set_collation()) its collation is the primary key.
+    """
+    if "\\" in text:
+        text = re_latex.sub(latex_letter, text)
+    if collation_transform is not None:
+        return (collation_transform(unicodedata.normalize(
+            "NFC", text.casefold())), u"")
+    if text.isascii():
+        folded = text.lower()
+        return folded, folded
+    folded = unicodedata.normalize("NFKD", text.casefold())
+    return (u"".join(char for char in folded
+                     if not unicodedata.combining(char)), folded)
+
+
+def latex_letter(match):
+    """Return letter with combining accent for match of re_latex."""
+    if match.group(1):
+        return match.group(2) + latex_accents[match.group(1)]
+    return match.group(3)
+
+
+def person_key(person):
+    """Return primary and secondary sort key of Person.
+
+    Surname and forename are joined by "\x00", which sorts before any
+    character of the keys, so strings compare like tuples but faster. The
+    key is kept by the instance, which parse_names() shares between
+    entries and runs.
+    """
+    if person.collation is None or person.collation[0] != collation_locale:
+        surname = collation_key(person.surname)
+        forename = collation_key(person.forename)
+        person.collation = (collation_locale,
+                            (surname[0] + u"\x00" + forename[0],
+                             surname[1] + u"\x00" + forename[1]))
+    return person.collation[1]
+
+
+def year_key(year):
+    """Return sort key of year; numbers come first, in numerical order."""
+    if year.isdecimal():
+        return 0, int(year), u""
+    return 1, 0, collation_key(year)[0]
+
+
+def sort_key(entry):
+    """Return key of instance of Entry in the reference list.
+
+    Entries are sorted by surname and forename of their authors, year,
+    title and BibTeX key; entries without authors come last. Accents are
+    compared after all of these but the key (cf. collation_key()).
+    """
+    names = [person_key(person) for person in entry.authors]
+    title = collation_key(entry.fields.get("title", no_title))
+    return (not entry.authors,
+            u"\x00".join(primary for primary, _ in names),
+            year_key(entry.year), title[0],
+            u"\x00".join(secondary for _, secondary in names), title[1],
+            entry.key)
+
+
+def year_suffix(number):
+    """Return letters of number-th (from 0) work of the same citation.
+
+    a, b, ..., z, aa, ab etc.
+    """
+    letters = u""
+    number += 1
+    while number:
+        number, rest = divmod(number - 1, 26)
+        letters = chr(ord("a") + rest) + letters
+    return letters
+
+
+def format_names(persons):
+    """Return persons as "surname, forename and surname, forename"."""
+    return name_separator.join(str(person) for person in persons)
+
+
+def cite_names(persons):
+    """Return surnames for author-year citation.
+
+    One or two surnames are given, more are abbreviated with "et al.".
+    """
+    if not persons:
+        return no_author
+    if len(persons) == 1:
+        return persons[0].surname
+    if len(persons) == 2:
+        return name_separator.join(person.surname for person in persons)
+    return u"{} et al.".format(persons[0].surname)
+
+
+class Entry(object):
+    """Cited entry of .bib file."""
+
+    __slots__ = ("key", "type", "authors", "editors", "year", "fields")
+
+    def __init__(self, key, mytype, field_dict, authors=(), editors=()):
+        """Initialize an instance of the class.
+
+        key -- BibTeX key
+        mytype -- entry type (lower case)
+        field_dict -- dict of fields and values; 'year' is added if missing
+        authors -- tuple of Person (default ())
+        editors -- tuple of Person (default ())
+        """
+        if "year" not in field_dict:
+            field_dict = dict(field_dict, year=no_year)
+        self.key = key
+        self.type = type_names.get(mytype, mytype)
+        self.authors = authors
+        self.editors = editors
+        self.year = field_dict["year"]
+        self.fields = field_dict
+
+    @property
+    def author(self):
+        """Return first author (or anonymous)."""
+        return self.authors[0] if self.authors else anonymous
+
+    def __repr__(self):
+        """Return representation of the instance."""
+        return "Entry({!r}, {!r}, {!r}, {!r}, {!r})".format(
+            self.key, self.type, self.fields, self.authors, self.editors)
+
+
+def cite_text(names, year, prefix=None, suffix=u""):
+    """Return author-year citation, e.g. "(cf. Arendt 2000: p. 5)".
+
+    names -- surnames of citation, cf. cite_names()
+    year -- year of entry
+    prefix -- text before names (default None)
+    suffix -- page(+suffix) after year (default "")
+    """
+    # prefix and page(+suffix):
+    if prefix and suffix:
+        return u"({} {} {}: {})".format(prefix, names, year, suffix)
+    # prefix:
+    if prefix:
+        return u"({} {} {})".format(prefix, names, year)
+    # page(+suffix):
+    if suffix:
+        return u"({} {}: {})".format(names, year, suffix)
+    # nothing:
+    return u"({} {})".format(names, year)
+
+
+def text_bibliography(title, references, day):
+    """Return reference list as plain text.
+
+    title -- title of reference list
+    references -- list of Reference
+    day -- date of generation
+    """
+    chunks = [u"\n{}\n{}".format(title, len(title)*u"=")]
+    chunks.extend(u"\n" + reference.text for reference in references)
+    chunks.append(u"\n\nGenerated with Bib.tXt (c) by Max Harder. {}."
+                  .format(day))
+    return u"".join(chunks)
+
+
+class Citation(object):
+    """Resolved citation of .txt file."""
+
+    __slots__ = ("key", "names", "year", "prefix", "suffix")
+
+    def __init__(self, key, names, year, prefix=None, suffix=u""):
+        """Initialize an instance of the class.
+
+        key -- BibTeX key
+        names -- surnames of citation, cf. cite_names()
+        year -- year of entry
+        prefix -- text before names (default None)
+        suffix -- page(+suffix) after year (default "")
+        """
+        self.key = key
+        self.names = names
+        self.year = year
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def __str__(self):
+        """Return citation as plain text, cf. cite_text()."""
+        return cite_text(self.names, self.year, self.prefix, self.suffix)
+
+
+class Reference(object):
+    """Formatted entry of reference list."""
+
+    __slots__ = ("key", "text", "entry")
+
+    def __init__(self, key, text, entry):
+        """Initialize an instance of the class.
+
+        key -- BibTeX key
+        text -- entry formatted with the template of its type
+        entry -- instance of Entry
+        """
+        self.key = key
+        self.text = text
+        self.entry = entry
+
+
+class Document(object):
+    """Intermediate representation of output, cf. writers.py."""
+
+    __slots__ = ("segments", "title", "references", "day")
+
+    def __init__(self, segments, title, references, day):
+        """Initialize an instance of the class.
+
+        segments -- list of text (str) and Citation in order of .txt file
+        title -- title of reference list
+        references -- list of Reference in order of reference list
+        day -- date of generation
+        """
+        self.segments = segments
+        self.title = title
+        self.references = references
+        self.day = day
 
 
 class BibTeX(object):
@@ -25,13 +846,36 @@ class BibTeX(object):
     author-year citations and reference list.
     """
 
-    def __init__(self, txt=None, bib=None, output=None):
+    def __init__(self, txt=None, bib=None, output=None, title=None,
+                 cache=None, style="default"):
         """Initialize an instance of the class.
 
+        If txt and bib are given, no prompts are shown and output may be
+        a path, a writable stream or None (nothing is written).
+
         txt -- user's .txt file (default None)
-        bib --  user's .bib file (default None)
+        bib --  user's .bib file, file object, list of entries returned
+        by iter_entries() or instance of store.BibStore (default None)
         output -- path to output file (default None)
+        title -- title of reference list (default None)
+        cache -- instance of cache.BibCache for parsed .bib files
+        (default None)
+        style -- name of citation style of reference list (default
+        "default")
         """
+        self.title = title
+        self.cache = cache
+        self.style = style
+        # (cited entries, keys in order of reference list), cf. sorted_keys():
+        self.order = None
+        # (cited entries, labels), cf. cite_labels():
+        self.labels = None
+        self.interactive = txt is None or bib is None
+        if not self.interactive:
+            self.txt = txt
+            self.bib = bib
+            self.output = output
+            return
         welcome = ("----------------------------"
                    "\nBib.tXt (c) {} Max Harder.\n"
                    "----------------------------".format(date.today().year))
@@ -124,431 +968,538 @@ class BibTeX(object):
             except (OSError, IOError):
                 print(ioerror)
 
-            self.txt = txt
-            self.bib = bib
-            self.output = output
+        self.txt = txt
+        self.bib = bib
+        self.output = output
+
+    def write(self, content):
+        """Append content to output in one write.
 
-    def check_all_keys(self):
+        Streams passed as output are left open. Nothing is written if
+        output is None.
+        """
+        if self.output is None:
+            return
+        if hasattr(self.output, "write"):
+            self.output.write(content)
+            return
+        with io.open(self.output, mode="a", encoding="utf-8") as file:
+            file.write(content)
+
+    def check_all_keys(self, all_keys_txt=None):
         """Check all occurrences of BibTeX keys.
 
         Return list of keys occurring in .bib but not in .txt file. Exit if
         multiple occurrences of key in .bib file exist or if key in .txt
-        file is not specified in .bib file.
+        file is not specified in .bib file. All such keys are reported at
+        once.
+
+        all_keys_txt -- dict of cited keys (default None, i.e. scan .txt)
         """
-        re_keys = r"\\cite(?:\[[^[\]]*\])?(?:\[[^[\]]*\])?{(\w+)}"
-        all_keys_txt = re.findall(re_keys, self.txt)
-        all_keys_bib = re.findall(r"@\w+\{(\w+),", self.bib)
-        key_not_in_txt = [key for key in all_keys_bib if
+        if all_keys_txt is None:
+            self.citations = list(iter_citations(self.txt))
+            # dict of cited keys in order of first occurrence:
+            all_keys_txt = dict.fromkeys(citation[4] for citation
+                                         in self.citations)
+        self.read_bib(all_keys_txt)
+        key_count = self.key_count
+        key_not_in_txt = [key for key in key_count if
                           key not in all_keys_txt]
-        for txt_key in all_keys_txt:
-            if all_keys_bib.count(txt_key) > 1:
-                sys.exit("Error: Reoccurrence of the BibTeX key \'{}\'"
-                         " detected. Please revise entered .bib file."
-                         .format(txt_key))
-            if txt_key not in all_keys_bib:
-                sys.exit("Error: \'{}\' is not a specified BibTeX key."
-                         " Please revise entered .txt or .bib file."
-                         .format(txt_key))
+        reoccurring = [key for key in all_keys_txt if key_count[key] > 1]
+        unknown = [key for key in all_keys_txt if key not in key_count]
+        errors = []
+        if reoccurring:
+            errors.append("Error: Reoccurrence of the BibTeX {} {} detected."
+                          " Please revise entered .bib file.".format(
+                           "key" if len(reoccurring) == 1 else "keys",
+                           quote_all(reoccurring)))
+        if unknown:
+            errors.append("Error: {} {}. Please revise entered .txt or .bib "
+                          "file.".format(quote_all(unknown),
+                                         "is not a specified BibTeX key"
+                                         if len(unknown) == 1 else
+                                         "are not specified BibTeX keys"))
+        if errors:
+            raise BibTeXError("\n".join(errors))
         return key_not_in_txt
 
+    def read_bib(self, cited):
+        """Tokenize .bib file in a single pass.
+
+        Store the number of occurrences of every key, all entry types,
+        (type, fields) of every cited key and of the entries they
+        cross-reference (parents) as well as the @string and @preamble
+        entries. Fields of other keys are not kept. Parents preceding their
+        children (which BibTeX does not allow) are found by another pass.
+        If bib is a store, only cited keys and their parents are read.
+
+        cited -- keys cited in .txt file
+        """
+        # parsed names of cited keys, if known beforehand:
+        self.names = {}
+        # raw values of macros: {lower-case name: value}
+        self.macros = dict(macros)
+        self.preambles = []
+        # cross-referenced entries which are not cited: {key: (type, fields)}
+        self.parents = {}
+        # memoized results of expand_macro() and resolve():
+        self.expanded = {}
+        self.resolved = {}
+        if hasattr(self.bib, "lookup"):
+            # store of entries (cf. store.BibStore); only cited keys are read:
+            (self.key_count, self.all_types, self.entries,
+             self.names) = self.bib.lookup(cited)
+            for mytype, field_dict in self.bib.macros():
+                self.add_macros(mytype, field_dict)
+            self.read_parents(lambda keys: self.bib.lookup(keys)[2])
+            return
+        self.key_count = Counter()
+        # dict of entry types in order of first occurrence:
+        self.all_types = {}
+        self.entries = {}
+        if isinstance(self.bib, list):
+            # entries parsed beforehand:
+            all_entries = self.bib
+        elif self.cache is not None:
+            all_entries = parse_entries(self.bib, self.cache)
+        else:
+            all_entries = iter_entries(self.bib)
+        # keys whose entries are kept (cited keys and their parents):
+        wanted = set(cited)
+        for mytype, key, field_dict in all_entries:
+            if not key and mytype.lower() in macro_types:
+                self.add_macros(mytype, field_dict)
+                continue
+            self.key_count[key] += 1
+            self.all_types[mytype] = None
+            if (key in wanted and key not in self.entries
+               and key not in self.parents):
+                if key in cited:
+                    self.entries[key] = (mytype, field_dict)
+                else:
+                    self.parents[key] = (mytype, field_dict)
+                if "crossref" in field_dict:
+                    wanted.add(field_dict["crossref"])
+        self.read_parents(lambda keys: self.find_entries(keys, all_entries))
+
+    def add_macros(self, mytype, field_dict):
+        """Keep raw values of @string or @preamble entry.
+
+        Other (keyless) entries are ignored.
+        """
+        if mytype.lower() == "string":
+            self.macros.update(field_dict)
+        elif mytype.lower() == "preamble":
+            self.preambles.append(field_dict["preamble"])
+
+    def missing_parents(self):
+        """Return set of cross-referenced keys which have not been read."""
+        missing = set()
+        for kept in (self.entries, self.parents):
+            for _, field_dict in kept.values():
+                parent = field_dict.get("crossref")
+                if (parent and parent not in self.entries
+                   and parent not in self.parents):
+                    missing.add(parent)
+        return missing
+
+    def read_parents(self, find):
+        """Read missing parents (and theirs) until none can be found.
+
+        find -- function returning {key: (type, fields)} for a set of keys
+        or None if the .bib file cannot be read again
+        """
+        searched = set()
+        missing = self.missing_parents()
+        while missing:
+            found = find(missing)
+            if found is None:
+                return
+            searched.update(missing)
+            for key, entry in found.items():
+                self.parents.setdefault(key, entry)
+            missing = self.missing_parents() - searched
+
+    def find_entries(self, keys, all_entries):
+        """Return {key: (type, fields)} of keys by another pass.
+
+        Return None if the .bib file cannot be read again (e.g. a pipe).
+
+        keys -- set of keys
+        all_entries -- entries of the first pass (list or iterator)
+        """
+        if isinstance(all_entries, list):
+            rest = all_entries
+        elif isinstance(self.bib, str):
+            rest = iter_entries(self.bib)
+        elif hasattr(self.bib, "seekable") and self.bib.seekable():
+            self.bib.seek(0)
+            rest = iter_entries(self.bib)
+        else:
+            return None
+        found = {}
+        for mytype, key, field_dict in rest:
+            if key in keys and key not in found:
+                found[key] = (mytype, field_dict)
+        return found
+
+    def resolve(self, key, resolving=()):
+        """Return fields of kept entry with macros and crossref resolved.
+
+        Fields missing in the entry are inherited from the entry named by
+        its crossref field (which may have a crossref itself); the title of
+        the parent is the booktitle of the child, unless given. The result
+        is memoized, so a parent shared by many entries is resolved once.
+        Exit if entries cross-reference each other in a cycle.
+
+        key -- key of cited entry or parent
+        resolving -- keys of children being resolved (default ())
+        """
+        field_dict = self.resolved.get(key)
+        if field_dict is not None:
+            return field_dict
+        if key in resolving:
+            raise BibTeXError("Error: The BibTeX keys {} cross-reference "
+                              "each other. Please revise entered .bib "
+                              "file.".format(quote_all(
+                               resolving[resolving.index(key):])))
+        _, field_dict = (self.entries[key] if key in self.entries
+                         else self.parents[key])
+        field_dict = self.expand_fields(field_dict)
+        parent = field_dict.get("crossref")
+        if parent in self.entries or parent in self.parents:
+            inherited = dict(self.resolve(parent, resolving + (key,)))
+            if "title" in inherited:
+                inherited.setdefault("booktitle", inherited["title"])
+            inherited.update(field_dict)
+            field_dict = inherited
+        self.resolved[key] = field_dict
+        return field_dict
+
+    def expand_fields(self, field_dict):
+        """Return fields of entry with macros replaced by their values.
+
+        Values are cleaned as by parse_fields(); crossref is not resolved
+        (cf. resolve()). The macros are those of the .bib file read by
+        read_bib().
+
+        field_dict -- fields of entry returned by iter_entries()
+        """
+        if not any(macro_mark in value for value in field_dict.values()):
+            return field_dict
+        return {name: (clean_value(self.expand(value), name in name_fields)
+                       if macro_mark in value else value)
+                for name, value in field_dict.items()}
+
+    def expand(self, value, resolving=()):
+        """Return raw value with names of macros replaced by their values.
+
+        Unknown names are kept as they are (e.g. bare words).
+
+        value -- raw value (cf. read_value())
+        resolving -- names of macros being expanded (default ())
+        """
+        parts = value.split(macro_mark)
+        for index in range(1, len(parts), 2):
+            parts[index] = self.expand_macro(parts[index], resolving)
+        return u"".join(parts)
+
+    def expand_macro(self, name, resolving=()):
+        """Return (memoized) value of macro or name if it is unknown.
+
+        Exit if macros refer to each other in a cycle.
+        """
+        lower = name.lower()
+        value = self.expanded.get(lower)
+        if value is not None:
+            return value
+        if lower not in self.macros:
+            return name
+        if lower in resolving:
+            raise BibTeXError("Error: The @string macros {} refer to each "
+                              "other. Please revise entered .bib file."
+                              .format(quote_all(
+                               resolving[resolving.index(lower):])))
+        value = self.expand(self.macros[lower], resolving + (lower,))
+        self.expanded[lower] = value
+        return value
+
+    def preamble(self):
+        """Return text of @preamble entries with macros expanded."""
+        return u"".join(self.expand(value) for value in self.preambles)
+
     def check_all_types(self):
         """Check all entry types in .bib file. Exit if type is not valid."""
-        all_types = re.findall(r"@(\w+)\{", self.bib)
-        for mytype in all_types:
-            if mytype.lower() not in types:
-                sys.exit("Error: \'{}\' is not a valid entry type."
-                         " Please revise entered .bib file.".format(mytype))
+        for mytype in self.all_types:
+            if (mytype.lower() not in types
+               and mytype.lower() not in macro_types):
+                raise BibTeXError("Error: \'{}\' is not a valid entry type."
+                                  " Please revise entered .bib file."
+                                  .format(mytype))
 
     def bib_to_dict(self, key_not_in_txt):
         """Convert data of .bib file into dict and return dict.
 
-        Three-layer dict: keys, fields, values.
+        Keys and instances of Entry.
         """
-        re_bib = r"@\w+\{"+"(\w+)"+",([\w\s={}\/\.:,;-]+)(?=(?:@\w+\{)|\Z)"
-        basis_dict, field_value_dict = {}, {}
-        # tuple_list: [(key, field=value,\n etc.) etc.]
-        tuple_list = [match.group(1, 2) for match in
-                      re.finditer(re_bib, self.bib, re.UNICODE)]
-        # key_val_tuple: (key, field=value,\n …)
-        key_list = [key_val_tuple[0] for key_val_tuple in tuple_list]
-        for key_val_tuple in tuple_list:
-            basis_dict[key_val_tuple[0]] = key_val_tuple[1].splitlines()
-        for key in key_list:
-            # unsplit_data: field=value
-            for unsplit_data in basis_dict[key]:
-                # strip whitespace from the beginning of the string:
-                unsplit_data = unsplit_data.lstrip()
-                if any([unsplit_data.lower()
-                        .startswith(field) for field in fields]):
-                    split_data = re.split(r"\s+=\s+", unsplit_data)
-                    final_value = re.search(r"{*([\w\s\/\.:,;-]+)}*",
-                                            split_data[1], re.UNICODE).group(1)
-                    # remove comma after digit and full stop after title etc.:
-                    if final_value.endswith((",", ".")):
-                        final_value = final_value[:-1]
-                    field_value_dict[split_data[0].lower()] = final_value
-            basis_dict[key] = {}
-            basis_dict[key].update(field_value_dict)
-            field_value_dict = {}
-            if "author" in basis_dict[key]:
-                if "," in basis_dict[key]["author"]:
-                    split_name = basis_dict[key]["author"].split(",")
-                    surname = split_name[0].strip()
-                    forename = split_name[1].strip()
-                    basis_dict[key]["author"] = {"surname": surname}
-                    basis_dict[key]["author"].update({"forename": forename})
-                else:
-                    split_name = basis_dict[key]["author"].split()
-                    surname = split_name[-1].strip()
-                    forename = " ".join(split_name[:-1]).strip()
-                    basis_dict[key]["author"] = {"surname": surname}
-                    basis_dict[key]["author"].update({"forename": forename})
+        basis_dict = {}
+        for key, (mytype, stored) in self.entries.items():
+            # macros and crossref are resolved for cited keys only:
+            field_dict = self.resolve(key)
+            if key in self.names and field_dict is stored:
+                authors, editors = self.names[key]
+            else:
+                authors = parse_names(field_dict.get("author", u""))
+                editors = parse_names(field_dict.get("editor", u""))
+            basis_dict[key] = Entry(key, mytype.lower(), field_dict, authors,
+                                    editors)
         # remove keys not occurring in .txt file
         for ghost_key in key_not_in_txt:
-            basis_dict.pop(ghost_key)
-        for key in basis_dict.keys():
-            basis_dict[key]["author"] = basis_dict[key].get(
-                                        "author", {"surname": no_author,
-                                                   "forename": ""})
-            basis_dict[key]["year"] = basis_dict[key].get("year", no_year)
+            basis_dict.pop(ghost_key, None)
         return basis_dict
 
+    def check_entries(self, all_keys_txt=None):
+        """Check keys, types and fields of .bib file and keep cited entries.
+
+        The steps shared by all renderers, each timed as a stage of the
+        profiler. Return (basis_dict, key_type_dict) of bib_to_dict() and
+        check_required_fields().
+
+        all_keys_txt -- cited keys (default None, cf. check_all_keys())
+        """
+        with stage("check_all_keys"):
+            key_not_in_txt = self.check_all_keys(all_keys_txt)
+        with stage("check_all_types"):
+            self.check_all_types()
+        with stage("bib_to_dict"):
+            basis_dict = self.bib_to_dict(key_not_in_txt)
+        with stage("check_required_fields"):
+            key_type_dict = self.check_required_fields(basis_dict)
+        count("entries", sum(self.key_count.values()))
+        count("cited_entries", len(basis_dict))
+        return basis_dict, key_type_dict
+
     def check_required_fields(self, basis_dict):
         """Check if required fields are given in .bib file.
 
-        Return dict of keys and their entry types. Exit if required field is
-        not given.
+        Return dict of keys and their entry types. Exit if required fields
+        are not given; all missing fields are reported at once.
         """
-        field_error = ("Error: \'{}\' is a required field for \'{}\'. "
-                       "Please revise entered .bib file.")
+        field_error = ("Error: \'{}\' is a required field for \'{}\' "
+                       "(\'{}\'). Please revise entered .bib file.")
         field_error_2 = ("Error: \'{}\' or \'{}\' is a required field for "
-                         "\'{}\'. Please revise entered .bib file.")
-        key_type_tuples = [match.group(2, 1) for match
-                           in re.finditer(r"@(\w+)\{(\w+),", self.bib)]
-        for mytuple in key_type_tuples:
-            for key in basis_dict.keys():
-                if key in mytuple:
-                    given = [field.lower() for field in basis_dict[key].keys()]
-                    # remove generated entries for 'author':
-                    if basis_dict[key]["author"]["surname"] == no_author:
-                        given.remove("author")
-                    for needed in entry_types[mytuple[1].lower()]["required"]:
-                        split_fields = [element for element
-                                        in needed.split("/")
-                                        if re.findall(r"\w+/\w+", needed)]
-                        if needed not in given:
-                            if re.findall(r"\w+/\w+", needed):
-                                if (split_fields[0] not in given
-                                   and split_fields[1] not in given):
-                                    sys.exit(field_error_2
-                                             .format(split_fields[0],
-                                                     split_fields[1],
-                                                     mytuple[1]))
-                            else:
-                                sys.exit(field_error
-                                         .format(needed, mytuple[1]))
-        key_type_dict = dict(key_type_tuples)
+                         "\'{}\' (\'{}\'). Please revise entered .bib file.")
+        key_type_dict = {key: self.entries[key][0] for key in basis_dict}
+        errors = []
+        for key, mytype, alternatives in self.missing_fields(basis_dict,
+                                                              key_type_dict):
+            if len(alternatives) > 1:
+                errors.append(field_error_2.format(alternatives[0],
+                                                   alternatives[1], mytype,
+                                                   key))
+            else:
+                errors.append(field_error.format(alternatives[0], mytype,
+                                                 key))
+        if errors:
+            raise BibTeXError("\n".join(errors))
         return key_type_dict
 
+    def missing_fields(self, basis_dict, key_type_dict):
+        """Return list of (key, type, alternatives) of missing fields.
+
+        alternatives is a tuple of fields of which one is required.
+        """
+        report = []
+        for key, mytype in key_type_dict.items():
+            given = basis_dict[key].fields
+            # generated entries for 'author' do not count:
+            no_author_given = not basis_dict[key].authors
+            for alternatives in required[mytype.lower()]:
+                for field in alternatives:
+                    if field in given and not (field == "author"
+                                               and no_author_given):
+                        break
+                else:
+                    report.append((key, mytype, alternatives))
+        return report
+
     def transfer(self, basis_dict):
-        """Transfer (modified) content of .txt to output file.
+        """Transfer (modified) content of .txt to output and return it.
 
         Transfer content and convert references into author-year citations.
+        The content is built in memory and written at once.
+        """
+        content = self.substitute(self.cite_labels(basis_dict), self.txt,
+                                  self.citations)
+        self.write(content)
+        return content
+
+    def cite_labels(self, basis_dict):
+        """Return dict of keys and (surnames, year) of their citations.
+
+        Works of the same surnames and year get letters in order of the
+        reference list, e.g. 2020a and 2020b (n.d.-a and n.d.-b). The
+        labels are kept for further calls with the same entries.
         """
-        all_varieties = r"(\\cite(?:\[([^[\]]*)\])?(?:\[([^[\]]*)\])?{(\w+)})"
-        page_only = r"(\\cite(?:\[([^[\]]*)\]){(\w+)})"
-        # quotes: [(u'\\cite[x][y]{z}', u'x', u'y', u'z') etc.]
-        quotes = re.findall(all_varieties, self.txt)
-        cite_start = ([match.start() for match in re.finditer
-                      (r"\\cite(?:\[[^[\]]*\]){0,2}{\w+}", self.txt)])
-        cite_end = ([match.end() for match in re.finditer
-                    (r"\\cite(?:\[[^[\]]*\]){0,2}{\w+}", self.txt)])
-        # cite_position: [(1st, 1st), (2nd, 2nd) etc.]
-        cite_position = list(zip(cite_start, cite_end))
-        start, count, num = 0, 1, 0
-        for position in cite_position:
-            with io.open(self.output, mode="a", encoding="utf-8") as file:
-                file.write(self.txt[start:position[0]])
-                # page(+suffix):
-                if (re.match(page_only, quotes[num][0])
-                   and quotes[num][1] and not quotes[num][2]):
-                    file.write(u"({} {}: {})".format(
-                               basis_dict[quotes[num][3]]["author"]["surname"],
-                               basis_dict[quotes[num][3]]["year"],
-                               quotes[num][1]))
-                # prefix:
-                elif quotes[num][1] and not quotes[num][2]:
-                    file.write(u"({} {} {})".format(
-                               quotes[num][1],
-                               basis_dict[quotes[num][3]]["author"]["surname"],
-                               basis_dict[quotes[num][3]]["year"]))
-                # prefix and page(+suffix):
-                elif quotes[num][1] and quotes[num][2]:
-                    file.write(u"({} {} {}: {})".format(
-                               quotes[num][1],
-                               basis_dict[quotes[num][3]]["author"]["surname"],
-                               basis_dict[quotes[num][3]]["year"],
-                               quotes[num][2]))
-                # nothing:
-                elif not quotes[num][1] and not quotes[num][2]:
-                    file.write(u"({} {})".format(
-                               basis_dict[quotes[num][3]]["author"]["surname"],
-                               basis_dict[quotes[num][3]]["year"]))
-                if count == len(cite_position):
-                    file.write(self.txt[position[1]:])
-            start = position[1]
-            count += 1
-            num += 1
+        if self.labels is not None and self.labels[0] is basis_dict:
+            return self.labels[1]
+        labels = {key: (cite_names(entry.authors), entry.year)
+                  for key, entry in basis_dict.items()}
+        self.labels = (basis_dict, labels)
+        works = Counter(labels.values())
+        if len(works) == len(labels):
+            return labels
+        seen = Counter()
+        for key in self.sorted_keys(basis_dict):
+            names, year = label = labels[key]
+            if works[label] > 1:
+                separator = u"" if year[-1:].isdigit() else u"-"
+                labels[key] = (names,
+                               year + separator + year_suffix(seen[label]))
+                seen[label] += 1
+        return labels
+
+    def sorted_keys(self, basis_dict):
+        """Return keys of cited entries in order of the reference list.
+
+        The sort key of every entry is computed once (cf. sort_key()) and
+        the order is kept for further calls with the same entries.
+        """
+        if self.order is None or self.order[0] is not basis_dict:
+            self.order = (basis_dict,
+                          sorted(basis_dict,
+                                 key=lambda key: sort_key(basis_dict[key])))
+        return self.order[1]
+
+    def substitute(self, labels, text, citations):
+        """Return text with citations converted into author-year citations.
+
+        labels -- dict of keys and (surnames, year), cf. cite_labels()
+        text -- (piece of) content of .txt file
+        citations -- records of iter_citations() for text
+        """
+        chunks = []
+        start = 0
+        for cite_start, cite_end, prefix, suffix, key in citations:
+            chunks.append(text[start:cite_start])
+            surname, year = labels[key]
+            chunks.append(cite_text(surname, year, prefix, suffix))
+            start = cite_end
+        chunks.append(text[start:])
+        return u"".join(chunks)
+
+    def segments(self, labels, text, citations):
+        """Return list of text (str) and instances of Citation.
+
+        Counterpart of substitute() for the intermediate representation.
+        """
+        segments = []
+        start = 0
+        for cite_start, cite_end, prefix, suffix, key in citations:
+            segments.append(text[start:cite_start])
+            names, year = labels[key]
+            segments.append(Citation(key, names, year, prefix, suffix))
+            start = cite_end
+        segments.append(text[start:])
+        return segments
+
+    def references(self, data, key_type_dict):
+        """Return list of Reference in order of the reference list.
+
+        Entries are sorted by sorted_keys() and formatted with the first
+        matching template of the style or else of the default style, so
+        every cited entry is listed. Years carry the letters of
+        cite_labels(). Exit if no template fits an entry.
+        """
+        style = get_style(self.style)
+        default = get_style("default")
+        labels = self.cite_labels(data)
+        references = []
+        for key in self.sorted_keys(data):
+            values = template_values(data[key])
+            values["year"] = labels[key][1]
+            mytype = key_type_dict[key].lower()
+            text = format_entry(style.get(mytype, ()), values)
+            if text is None:
+                text = format_entry(default.get(mytype, ()), values)
+            if text is None:
+                raise BibTeXError("Error: No template of citation style "
+                                  "\'{}\' fits \'{}\'. Please revise the "
+                                  "style or entered .bib file."
+                                  .format(self.style, key))
+            references.append(Reference(key, text, data[key]))
+        return references
+
+    def entitle(self):
+        """Return title of reference list (prompt user if not given)."""
+        if self.title is not None:
+            return self.title
+        if input("Entitle reference list \'Bibliography\' "
+                 "(y/[n])?") == "y":
+            return u"Bibliography"
+        title = ""
+        while not title:
+            try:
+                title = (input("Enter title of reference list: ")
+                         .decode("utf-8"))
+            except UnicodeDecodeError:
+                print("Error. Please use \"UTF-8\" or avoid special "
+                      "characters.")
+        return title
+
+    def document(self, basis_dict, key_type_dict):
+        """Return intermediate representation (Document) of the output.
+
+        Citations are resolved and the reference list is formatted once;
+        writers of writers.py turn it into text, Markdown, HTML or JSON.
+        """
+        labels = self.cite_labels(basis_dict)
+        return Document(self.segments(labels, self.txt, self.citations),
+                        self.entitle(),
+                        self.references(basis_dict, key_type_dict),
+                        date.fromtimestamp(time.time()))
 
     def bibliography(self, data, key_type_dict):
-        """Append bibliography to output file."""
-        entitle = input("Entitle reference list \'Bibliography\' (y/[n])?")
-        if entitle == "y":
-            title = u"Bibliography"
-            superscription = u"\n{}\n{}".format(title, len(title)*u"=")
-        else:
-            title = ""
-            while not title:
-                try:
-                    title = (input("Enter title of reference list: ")
-                             .decode("utf-8"))
-                except UnicodeDecodeError:
-                    print("Error. Please use \"UTF-8\" or avoid special "
-                          "characters.")
-            superscription = u"\n{}\n{}".format(title, len(title)*u"=")
-        signature = u"\n\nGenerated with Bib.tXt (c) by Max Harder. {}."
-        with io.open(self.output, mode="a", encoding="utf-8") as file:
-            file.write(superscription)
-            surname_key_tuples = [(data[element]["author"]["surname"],
-                                  element) for element in data]
-            surname_key_tuples.sort()
-            for tuple in surname_key_tuples:
-                # article
-                if key_type_dict[tuple[1]].lower() == "article":
-                    file.write(u"\n{}, {} ({}): {}. In: {} {}.".format(
-                               data[tuple[1]]["author"]["surname"],
-                               data[tuple[1]]["author"]["forename"],
-                               data[tuple[1]]["year"],
-                               data[tuple[1]]["title"],
-                               data[tuple[1]]["journal"],
-                               data[tuple[1]]["volume"]))
-                # book
-                elif key_type_dict[tuple[1]].lower() == "book":
-                    if data[tuple[1]]["author"]["surname"] != no_author:
-                        file.write(u"\n{}, {}; ed. {} ({}): {}. {}.".format(
-                                   data[tuple[1]]["author"]["surname"],
-                                   data[tuple[1]]["author"]["forename"],
-                                   data[tuple[1]].get("editor", no_author),
-                                   data[tuple[1]]["year"],
-                                   data[tuple[1]]["title"],
-                                   data[tuple[1]]["publisher"]))
-                    else:
-                        file.write(u"\n{}; ed. {} ({}): {}. {}.".format(
-                                   data[tuple[1]]["author"]["surname"],
-                                   data[tuple[1]].get("editor", no_author),
-                                   data[tuple[1]]["year"],
-                                   data[tuple[1]]["title"],
-                                   data[tuple[1]]["publisher"]))
-                # booklet
-                elif key_type_dict[tuple[1]].lower() == "booklet":
-                    if data[tuple[1]]["author"]["surname"] != no_author:
-                        file.write(u"\n{}, {} ({}): {}.".format(
-                                   data[tuple[1]]["author"]["surname"],
-                                   data[tuple[1]]["author"]["forename"],
-                                   data[tuple[1]]["year"],
-                                   data[tuple[1]]["title"]))
-                    else:
-                        file.write(u"\n{} ({}): {}.".format(
-                                   data[tuple[1]]["author"]["surname"],
-                                   data[tuple[1]]["year"],
-                                   data[tuple[1]]["title"]))
-                # conference
-                elif key_type_dict[tuple[1]].lower() == "conference":
-                    file.write(u"\n{}, {} ({}): {}. In: {}.".format(
-                               data[tuple[1]]["author"]["surname"],
-                               data[tuple[1]]["author"]["forename"],
-                               data[tuple[1]]["year"],
-                               data[tuple[1]]["title"],
-                               data[tuple[1]]["booktitle"]))
-                # inbook
-                elif key_type_dict[tuple[1]].lower() == "inbook":
-                    if data[tuple[1]]["author"]["surname"] != no_author:
-                        if ("chapter" in data[tuple[1]]
-                           and "pages" in data[tuple[1]]):
-                            file.write(u"\n{}, {}; ed. {} ({}): {}, "
-                                       "chapter {}, pages {}. {}.".format(
-                                        data[tuple[1]]["author"]["surname"],
-                                        data[tuple[1]]["author"]["forename"],
-                                        data[tuple[1]].get("editor",
-                                                           no_author),
-                                        data[tuple[1]]["year"],
-                                        data[tuple[1]]["title"],
-                                        data[tuple[1]]["chapter"],
-                                        data[tuple[1]]["pages"],
-                                        data[tuple[1]]["publisher"]))
-                        if ("chapter" in data[tuple[1]]
-                           and "pages" not in data[tuple[1]]):
-                            file.write(u"\n{}, {}; ed. {} ({}): {}, "
-                                       "chapter {}. {}.".format(
-                                        data[tuple[1]]["author"]["surname"],
-                                        data[tuple[1]]["author"]["forename"],
-                                        data[tuple[1]].get("editor",
-                                                           no_author),
-                                        data[tuple[1]]["year"],
-                                        data[tuple[1]]["title"],
-                                        data[tuple[1]]["chapter"],
-                                        data[tuple[1]]["publisher"]))
-                        if ("chapter" not in data[tuple[1]]
-                           and "pages" in data[tuple[1]]):
-                            file.write(u"\n{}, {}; ed. {} ({}): {}, "
-                                       "pages {}. {}.".format(
-                                        data[tuple[1]]["author"]["surname"],
-                                        data[tuple[1]]["author"]["forename"],
-                                        data[tuple[1]].get("editor",
-                                                           no_author),
-                                        data[tuple[1]]["year"],
-                                        data[tuple[1]]["title"],
-                                        data[tuple[1]]["pages"],
-                                        data[tuple[1]]["publisher"]))
-                    else:
-                        if ("chapter" in data[tuple[1]]
-                           and "pages" in data[tuple[1]]):
-                            file.write(u"\n{}; ed. {} ({}): {}, "
-                                       "chapter {}, pages {}. {}.".format(
-                                        data[tuple[1]]["author"]["surname"],
-                                        data[tuple[1]].get("editor",
-                                                           no_author),
-                                        data[tuple[1]]["year"],
-                                        data[tuple[1]]["title"],
-                                        data[tuple[1]]["chapter"],
-                                        data[tuple[1]]["pages"],
-                                        data[tuple[1]]["publisher"]))
-                        if ("chapter" in data[tuple[1]]
-                           and "pages" not in data[tuple[1]]):
-                            file.write(u"\n{}; ed. {} ({}): {}, "
-                                       "chapter {}. {}.".format(
-                                        data[tuple[1]]["author"]["surname"],
-                                        data[tuple[1]].get("editor",
-                                                           no_author),
-                                        data[tuple[1]]["year"],
-                                        data[tuple[1]]["title"],
-                                        data[tuple[1]]["chapter"],
-                                        data[tuple[1]]["publisher"]))
-                        if ("chapter" not in data[tuple[1]]
-                           and "pages" in data[tuple[1]]):
-                            file.write(u"\n{}; ed. {} ({}): {}, "
-                                       "pages {}. {}.".format(
-                                        data[tuple[1]]["author"]["surname"],
-                                        data[tuple[1]].get("editor",
-                                                           no_author),
-                                        data[tuple[1]]["year"],
-                                        data[tuple[1]]["title"],
-                                        data[tuple[1]]["pages"],
-                                        data[tuple[1]]["publisher"]))
-                # incollection
-                elif key_type_dict[tuple[1]].lower() == "incollection":
-                    file.write(u"\n{}, {} ({}): {}. In: {}, {}.".format(
-                               data[tuple[1]]["author"]["surname"],
-                               data[tuple[1]]["author"]["forename"],
-                               data[tuple[1]]["year"],
-                               data[tuple[1]]["title"],
-                               data[tuple[1]]["publisher"],
-                               data[tuple[1]]["booktitle"]))
-                # inproceedings
-                elif key_type_dict[tuple[1]].lower() == "inproceedings":
-                    file.write(u"\n{}, {} ({}): {}. In: {}.".format(
-                               data[tuple[1]]["author"]["surname"],
-                               data[tuple[1]]["author"]["forename"],
-                               data[tuple[1]]["year"],
-                               data[tuple[1]]["title"],
-                               data[tuple[1]]["booktitle"]))
-                # manual
-                elif key_type_dict[tuple[1]].lower() == "manual":
-                    if data[tuple[1]]["author"]["surname"] != no_author:
-                        file.write(u"\n{}, {} ({}): {}.".format(
-                                   data[tuple[1]]["author"]["surname"],
-                                   data[tuple[1]]["author"]["forename"],
-                                   data[tuple[1]]["year"],
-                                   data[tuple[1]]["title"]))
-                    else:
-                        file.write(u"\n{} ({}): {}.".format(
-                                   data[tuple[1]]["author"]["surname"],
-                                   data[tuple[1]]["year"],
-                                   data[tuple[1]]["title"]))
-                # mastersthesis
-                elif key_type_dict[tuple[1]].lower() == "mastersthesis":
-                    file.write(u"\n{}, {} ({}): {}. "
-                               "Master's thesis, {}.".format(
-                                data[tuple[1]]["author"]["surname"],
-                                data[tuple[1]]["author"]["forename"],
-                                data[tuple[1]]["year"],
-                                data[tuple[1]]["title"],
-                                data[tuple[1]]["school"]))
-                # misc
-                elif key_type_dict[tuple[1]].lower() == "misc":
-                    if data[tuple[1]]["author"]["surname"] != no_author:
-                        file.write(u"\n{}, {} ({}): {}.".format(
-                                   data[tuple[1]]["author"]["surname"],
-                                   data[tuple[1]]["author"]["forename"],
-                                   data[tuple[1]]["year"],
-                                   data[tuple[1]].get("title", no_title)))
-                    else:
-                        file.write(u"\n{} ({}): {}.".format(
-                                   data[tuple[1]]["author"]["surname"],
-                                   data[tuple[1]]["year"],
-                                   data[tuple[1]].get("title", no_title)))
-                # phdthesis
-                elif key_type_dict[tuple[1]].lower() == "phdthesis":
-                    file.write(u"\n{}, {} ({}): {}. PhD thesis, {}.".format(
-                               data[tuple[1]]["author"]["surname"],
-                               data[tuple[1]]["author"]["forename"],
-                               data[tuple[1]]["year"],
-                               data[tuple[1]]["title"],
-                               data[tuple[1]]["school"]))
-                # proceedings
-                elif key_type_dict[tuple[1]].lower() == "proceedings":
-                    if data[tuple[1]]["author"]["surname"] != no_author:
-                        file.write(u"\n{}, {}; ed. {} ({}): {}.".format(
-                                   data[tuple[1]]["author"]["surname"],
-                                   data[tuple[1]]["author"]["forename"],
-                                   data[tuple[1]].get("editor", no_author),
-                                   data[tuple[1]]["year"],
-                                   data[tuple[1]]["title"]))
-                    else:
-                        file.write(u"\n{}; ed. {} ({}): {}.".format(
-                                   data[tuple[1]]["author"]["surname"],
-                                   data[tuple[1]].get("editor", no_author),
-                                   data[tuple[1]]["year"],
-                                   data[tuple[1]]["title"]))
-                # techreport
-                elif key_type_dict[tuple[1]].lower() == "techreport":
-                    file.write(u"\n{}, {} ({}): {}. {}.".format(
-                               data[tuple[1]]["author"]["surname"],
-                               data[tuple[1]]["author"]["forename"],
-                               data[tuple[1]]["year"],
-                               data[tuple[1]]["title"],
-                               data[tuple[1]]["institution"]))
-                # unpublished
-                elif key_type_dict[tuple[1]].lower() == "unpublished":
-                    file.write(u"\n{}, {}: {}. {}.".format(
-                               data[tuple[1]]["author"]["surname"],
-                               data[tuple[1]]["author"]["forename"],
-                               data[tuple[1]]["title"],
-                               data[tuple[1]]["note"]))
-            file.write(signature.format(date.fromtimestamp(time.time())))
-        print("Output successfully created.\n"
-              "----------------------------")
-
-
-def pipe():
-    """Combine all methods of BibTeX()."""
-    example = BibTeX()
-    key_not_in_txt = example.check_all_keys()
-    example.check_all_types()
-    basis_dict = example.bib_to_dict(key_not_in_txt)
-    key_type_dict = example.check_required_fields(basis_dict)
-    example.transfer(basis_dict)
-    example.bibliography(basis_dict, key_type_dict)
+        """Append bibliography to output and return it."""
+        content = text_bibliography(self.entitle(),
+                                    self.references(data, key_type_dict),
+                                    date.fromtimestamp(time.time()))
+        self.write(content)
+        if self.interactive:
+            print("Output successfully created.\n"
+                  "----------------------------")
+        return content
+
+
+def stage(name):
+    """Return context manager recording stage name if profiler is set."""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
+
+
+def count(name, number=1):
+    """Add number to count of name if profiler is set."""
+    if profiler is not None:
+        profiler.count(name, number)
+
+
+def pipe(example=None):
+    """Combine all methods of BibTeX() and return the output.
+
+    example -- instance of BibTeX (default None, i.e. prompt user)
+    """
+    if example is None:
+        example = BibTeX()
+    basis_dict, key_type_dict = example.check_entries()
+    with stage("transfer"):
+        content = example.transfer(basis_dict)
+    with stage("bibliography"):
+        content += example.bibliography(basis_dict, key_type_dict)
+    count("documents")
+    count("citations", len(example.citations))
+    count("output_bytes", len(content.encode("utf-8")))
+    return content
 
 
 def run():
@@ -558,12 +1509,564 @@ def run():
         try:
             pipe()
             state = False
+        except BibTeXError as error:
+            sys.exit(u"{}".format(error))
         except AttributeError:
             close = input("Close program (y/[n])? ")
             if close == "y":
                 sys.exit()
 
 
-if __name__ == '__main__':
-    # code below is only executed when the module is run directly
-    run()
+def render(txt, bib, title=u"Bibliography", cache=None, style="default"):
+    """Return output for content of .txt and .bib file as string.
+
+    Counterpart of pipe() without any prompts.
+
+    txt -- content of .txt file
+    bib -- content of .bib file or file object
+    title -- title of reference list (default "Bibliography")
+    cache -- instance of cache.BibCache (default None)
+    style -- name of citation style (default "default")
+    """
+    return pipe(BibTeX(txt, bib, None, title, cache, style))
+
+
+def build_document(txt, bib, title=u"Bibliography", cache=None,
+                   style="default"):
+    """Return intermediate representation (Document) of output.
+
+    Counterpart of render() for writers.py: the .bib file is parsed and
+    the citations are resolved once for all output formats.
+
+    txt -- content of .txt file
+    bib -- content of .bib file, file object, list of entries or store
+    title -- title of reference list (default "Bibliography")
+    cache -- instance of cache.BibCache (default None)
+    style -- name of citation style (default "default")
+    """
+    example = BibTeX(txt, bib, None, title, cache, style)
+    basis_dict, key_type_dict = example.check_entries()
+    with stage("document"):
+        document = example.document(basis_dict, key_type_dict)
+    count("documents")
+    count("citations", len(example.citations))
+    return document
+
+
+def render_formats(txt, bib, outputs, title=u"Bibliography", cache=None,
+                   style="default"):
+    """Write output in several formats from one parse.
+
+    txt -- content of .txt file
+    bib -- content of .bib file, file object, list of entries or store
+    outputs -- dict of formats of writers.py (e.g. "html") and paths to
+    output files or writable streams
+    title -- title of reference list (default "Bibliography")
+    cache -- instance of cache.BibCache (default None)
+    style -- name of citation style (default "default")
+    """
+    import writers
+    document = build_document(txt, bib, title, cache, style)
+    for name, output in outputs.items():
+        with stage("write_" + name):
+            writers.write(document, name, output)
+
+
+def format_outputs(txt_path, args):
+    """Return outputs of render_formats() for .txt file and parsed arguments.
+
+    args -- parsed arguments of main()
+    """
+    import writers
+    return {name: (sys.stdout if args.stdout else
+                   output_path(txt_path, args.output_dir,
+                               writers.formats[name][1]))
+            for name in args.format}
+
+
+def render_stream(txt, bib, output, title=u"Bibliography", cache=None,
+                  size=chunk_size, style="default"):
+    """Render .txt file piece by piece and write output incrementally.
+
+    The .txt file is read twice: first to collect the cited keys, then
+    to convert the citations. Memory depends on size and the number of
+    entries, not on the length of the .txt file.
+
+    txt -- file object of .txt file (must support seek)
+    bib -- content of .bib file or file object
+    output -- path to output file or writable stream
+    title -- title of reference list (default "Bibliography")
+    cache -- instance of cache.BibCache (default None)
+    size -- number of characters read at once (default chunk_size)
+    style -- name of citation style (default "default")
+    """
+    example = BibTeX(u"", bib, None, title, cache, style)
+    all_keys_txt = {}
+    number = 0
+    with stage("scan"):
+        for _, citations in iter_txt(txt, size):
+            all_keys_txt.update(dict.fromkeys(citation[4] for citation
+                                              in citations))
+            number += len(citations)
+    basis_dict, key_type_dict = example.check_entries(all_keys_txt)
+    labels = example.cite_labels(basis_dict)
+    txt.seek(0)
+    written = 0
+    with contextlib.ExitStack() as stack:
+        if hasattr(output, "write"):
+            example.output = output
+        else:
+            example.output = stack.enter_context(
+                io.open(output, mode="w", encoding="utf-8"))
+        with stage("transfer"):
+            for text, citations in iter_txt(txt, size):
+                content = example.substitute(labels, text, citations)
+                example.write(content)
+                written += len(content.encode("utf-8"))
+        with stage("bibliography"):
+            content = example.bibliography(basis_dict, key_type_dict)
+    count("documents")
+    count("citations", number)
+    count("output_bytes", written + len(content.encode("utf-8")))
+
+
+def stop_profiling():
+    """Drop profiler of this process (initializer of forked workers).
+
+    Workers inherit the profiler of the parent process, but their stages
+    are not reported, so they do not trace allocations either.
+    """
+    global profiler
+    if profiler is not None:
+        profiler.stop()
+        profiler = None
+
+
+def init_worker(entries, registered_styles=None, locale_name=None):
+    """Initialize worker process of render_files() (cf. share_entries())."""
+    stop_profiling()
+    share_entries(entries, registered_styles, locale_name)
+
+
+def share_entries(entries, registered_styles=None, locale_name=None):
+    """Share parsed entries, citation styles and collation with workers."""
+    global shared_entries
+    shared_entries = entries
+    if registered_styles:
+        compiled_styles.update(registered_styles)
+    if locale_name != collation_locale:
+        set_collation(locale_name)
+
+
+def render_file(txt_path, output, title=u"Bibliography", style="default"):
+    """Render .txt file against shared_entries and return (content, error).
+
+    Errors are returned rather than raised, so they only affect this file.
+    content is None if the output is written to a file, error is None if
+    rendering succeeded.
+
+    txt_path -- path to .txt file
+    output -- path to output file or None (return content)
+    title -- title of reference list (default "Bibliography")
+    style -- name of citation style (default "default")
+    """
+    try:
+        with io.open(txt_path, encoding="utf-8") as file:
+            txt = file.read()
+        content = render(txt, shared_entries, title, style=style)
+        if output is not None:
+            with io.open(output, mode="w", encoding="utf-8") as file:
+                file.write(content)
+            content = None
+    except Exception as error:
+        return None, u"{}".format(error)
+    return content, None
+
+
+def render_files(txt_paths, bib, outputs, title=u"Bibliography", cache=None,
+                 jobs=1, style="default"):
+    """Render several .txt files against one .bib file.
+
+    The .bib file is parsed once. With more than one job, the files are
+    rendered by a pool of worker processes which inherit the parsed
+    entries (and large .bib files are parsed in shards). Return list of
+    (content, error) of render_file() in order of txt_paths.
+
+    txt_paths -- list of paths to .txt files
+    bib -- content of .bib file, file object or mapped file
+    outputs -- list of paths to output files or None (return content)
+    title -- title of reference list (default "Bibliography")
+    cache -- instance of cache.BibCache (default None)
+    jobs -- number of worker processes (default 1)
+    style -- name of citation style (default "default")
+    """
+    with stage("parse"):
+        # stores and mapped files are read lazily:
+        entries = (bib if hasattr(bib, "lookup")
+                   else parse_entries(bib, cache, jobs))
+    share_entries(entries)
+    titles = [title] * len(txt_paths)
+    style_names = [style] * len(txt_paths)
+    if jobs <= 1 or len(txt_paths) <= 1:
+        return list(map(render_file, txt_paths, outputs, titles,
+                        style_names))
+    from concurrent.futures import ProcessPoolExecutor
+    from shards import pool_context
+    # workers started by fork share the entries without copying them:
+    with ProcessPoolExecutor(jobs, mp_context=pool_context(),
+                             initializer=init_worker,
+                             initargs=(entries, compiled_styles,
+                                       collation_locale)) as executor:
+        return list(executor.map(render_file, txt_paths, outputs, titles,
+                                 style_names))
+
+
+def render_pairs(pairs, render_pair):
+    """Call render_pair(txt_path, bib) for all pairs and return exit status.
+
+    An error of one pair (e.g. in its .txt or .bib file, or a file which
+    is not valid UTF-8) is reported with the path of the .txt file; the
+    other pairs are rendered nevertheless.
+
+    pairs -- list of (path to .txt file, bib); bib is the path to a .bib
+    file, parsed entries or a store
+    render_pair -- function rendering one pair
+    """
+    status = 0
+    for txt_path, bib in pairs:
+        try:
+            render_pair(txt_path, bib)
+        except (IOError, ValueError) as error:
+            sys.stderr.write("{}: {}\n".format(txt_path, error))
+            status = 1
+    return status
+
+
+def open_bib(bib_path, mapped=False):
+    """Return .bib file opened for reading.
+
+    bib_path -- path to .bib file
+    mapped -- return memory-mapped file whose cited entries are parsed
+    lazily (cf. mapped.py; default False)
+    """
+    if mapped:
+        from mapped import MappedBib
+        return MappedBib(bib_path)
+    return io.open(bib_path, encoding="utf-8")
+
+
+def render_groups_formats(groups, args, cache=None, style="default"):
+    """Render .txt files in all formats of parsed arguments.
+
+    Each .bib file is parsed once. Return exit status.
+
+    groups -- dict of paths to .bib files and lists of paths to .txt files
+    args -- parsed arguments of main()
+    cache -- instance of cache.BibCache (default None)
+    style -- name of citation style (default "default")
+    """
+    def render_pair(txt_path, entries):
+        with io.open(txt_path, encoding="utf-8") as txt:
+            content = txt.read()
+        render_formats(content, entries, format_outputs(txt_path, args),
+                       args.title, style=style)
+
+    status = 0
+    for bib_path, txt_paths in groups.items():
+        try:
+            bib = open_bib(bib_path, args.mmap)
+        except IOError as error:
+            sys.stderr.write("{}: {}\n".format(bib_path, error))
+            status = 1
+            continue
+        with bib:
+            try:
+                with stage("parse"):
+                    # mapped files are parsed lazily:
+                    entries = (bib if hasattr(bib, "lookup")
+                               else parse_entries(bib, cache))
+            except ValueError as error:
+                # .bib file is not valid UTF-8:
+                sys.stderr.write("{}: {}\n".format(bib_path, error))
+                status = 1
+                continue
+            status |= render_pairs([(txt_path, entries)
+                                    for txt_path in txt_paths], render_pair)
+    return status
+
+
+def render_store(args, style="default"):
+    """Render .txt files of parsed arguments against a store.
+
+    Return exit status.
+
+    args -- parsed arguments of main()
+    style -- name of citation style (default "default")
+    """
+    from store import BibStore
+
+    def render_pair(txt_path, store):
+        output = (sys.stdout if args.stdout
+                  else output_path(txt_path, args.output_dir))
+        with io.open(txt_path, encoding="utf-8") as txt:
+            if args.format != ["text"]:
+                render_formats(txt.read(), store,
+                               format_outputs(txt_path, args), args.title,
+                               style=style)
+                return
+            if args.stream:
+                render_stream(txt, store, output, args.title, style=style)
+                return
+            content = render(txt.read(), store, args.title, style=style)
+        if args.stdout:
+            sys.stdout.write(content)
+        else:
+            with io.open(output, mode="w", encoding="utf-8") as file:
+                file.write(content)
+
+    status = 0
+    store = BibStore(args.store)
+    try:
+        if args.bib is not None:
+            store.update(args.bib)
+        status = render_pairs([(txt_path, store) for txt_path in args.files],
+                              render_pair)
+    except (IOError, ValueError) as error:
+        sys.stderr.write("{}: {}\n".format(args.bib, error))
+        status = 1
+    finally:
+        store.close()
+    return status
+
+
+def output_path(txt_path, output_dir=None, suffix="_bibtxt.txt"):
+    """Return path of output file for given .txt file.
+
+    txt_path -- path to .txt file
+    output_dir -- directory of output file (default None, i.e. directory
+    of .txt file)
+    suffix -- suffix of output file (default "_bibtxt.txt")
+    """
+    directory, name = os.path.split(txt_path)
+    if output_dir is not None:
+        directory = output_dir
+    return os.path.join(directory, name[:-len(".txt")] + suffix)
+
+
+def main(argv=None):
+    """Parse command line and render all given pairs of .txt and .bib files.
+
+    Without arguments the interactive program is run. Return exit status.
+
+    argv -- list of arguments (default None, i.e. sys.argv[1:])
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="BibtXt.py",
+        description="Convert \\cite commands into author-year citations and "
+                    "append a reference list.")
+    parser.add_argument("files", nargs="*", metavar="TXT BIB",
+                        help="pairs of .txt and .bib files (only .txt files "
+                             "if --bib is given)")
+    parser.add_argument("-b", "--bib", default=None,
+                        help="render all given .txt files against this .bib "
+                             "file")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes per .bib file "
+                             "(0: number of CPUs; default: %(default)s)")
+    parser.add_argument("-o", "--output-dir", default=None,
+                        help="directory of output files (default: directory "
+                             "of each .txt file)")
+    parser.add_argument("-t", "--title", default=u"Bibliography",
+                        help="title of reference list "
+                             "(default: %(default)s)")
+    parser.add_argument("-s", "--style", default="default",
+                        help="citation style of reference list: name of a "
+                             "style in data/styles.py or .json file of "
+                             "templates (default: %(default)s)")
+    parser.add_argument("--locale", default=None,
+                        help="sort reference list with the collation of "
+                             "this locale, e.g. de_DE.UTF-8 (default: "
+                             "Unicode-aware)")
+    parser.add_argument("--stdout", action="store_true",
+                        help="write output to stdout instead of files")
+    parser.add_argument("--cache-dir",
+                        default=os.environ.get("BIBTXT_CACHE_DIR"),
+                        help="cache parsed .bib files in this directory "
+                             "(default: $BIBTXT_CACHE_DIR, no cache if unset)")
+    parser.add_argument("--cache-size", type=int, default=256, metavar="MB",
+                        help="maximum size of cache (default: %(default)s)")
+    parser.add_argument("--clear-cache", action="store_true",
+                        help="remove all cached .bib files first")
+    parser.add_argument("--incremental", action="store_true",
+                        help="keep a manifest next to each output file and "
+                             "only convert changed paragraphs")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and render again whenever a .txt "
+                             "or .bib file changes")
+    parser.add_argument("--stream", action="store_true",
+                        help="read .txt files in chunks and write output "
+                             "incrementally (for very large files)")
+    parser.add_argument("--mmap", action="store_true",
+                        help="memory-map .bib files and only parse cited "
+                             "entries, using an index next to each .bib "
+                             "file (refs.bib.idx)")
+    parser.add_argument("-f", "--format", action="append",
+                        choices=["text", "markdown", "html", "json"],
+                        help="output format; repeat to write several "
+                             "formats from one parse (default: text)")
+    parser.add_argument("--store", metavar="DB",
+                        help="render .txt files against SQLite store DB "
+                             "(cf. store.py); with --bib the store is "
+                             "updated from the .bib file first")
+    parser.add_argument("--profile", metavar="REPORT",
+                        default=os.environ.get("BIBTXT_PROFILE"),
+                        help="write JSON report of time, memory and counts "
+                             "of each stage to REPORT ('-': stderr; "
+                             "default: $BIBTXT_PROFILE)")
+    parser.add_argument("--cprofile", metavar="FILE",
+                        default=os.environ.get("BIBTXT_CPROFILE"),
+                        help="dump cProfile statistics of the whole run to "
+                             "FILE (default: $BIBTXT_CPROFILE)")
+    args = parser.parse_args(argv)
+    global profiler
+    if args.profile is None and args.cprofile is None:
+        return convert(args, parser)
+    if args.profile is not None:
+        from instrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+    if args.cprofile is not None:
+        import cProfile
+        whole_run = cProfile.Profile()
+        whole_run.enable()
+    try:
+        return convert(args, parser)
+    finally:
+        if args.cprofile is not None:
+            whole_run.disable()
+            whole_run.dump_stats(args.cprofile)
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(args.profile)
+            profiler = None
+
+
+def convert(args, parser):
+    """Render all pairs of .txt and .bib files given by args.
+
+    Return exit status.
+
+    args -- parsed arguments of main()
+    parser -- argument parser of main() (for reporting errors)
+    """
+    cache = None
+    if args.cache_dir is not None:
+        from cache import BibCache
+        cache = BibCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        if args.clear_cache:
+            cache.invalidate()
+    if not args.files:
+        if args.clear_cache:
+            return 0
+        run()
+        return 0
+    if args.mmap and (args.incremental or args.watch or args.store):
+        parser.error("--mmap cannot be combined with --incremental, --watch "
+                     "or --store")
+    if args.store is not None:
+        if args.incremental or args.watch:
+            parser.error("--store cannot be combined with --incremental or "
+                         "--watch")
+        for txt_path in args.files:
+            if not txt_path.endswith(".txt"):
+                parser.error("\'{}\' is not a .txt file".format(txt_path))
+        pairs = []
+    elif args.bib is not None:
+        pairs = [(txt_path, args.bib) for txt_path in args.files]
+    elif len(args.files) % 2:
+        parser.error("files must be given as pairs of .txt and .bib file")
+    else:
+        pairs = list(zip(args.files[::2], args.files[1::2]))
+    for txt_path, bib_path in pairs:
+        if not txt_path.endswith(".txt") or not bib_path.endswith(".bib"):
+            parser.error("\'{}\' and \'{}\' are not a pair of .txt and .bib "
+                         "file".format(txt_path, bib_path))
+    if args.incremental and (args.stdout or args.stream):
+        parser.error("--incremental writes output files and cannot be "
+                     "combined with --stdout or --stream")
+    if args.watch and (args.stdout or args.stream or args.incremental):
+        parser.error("--watch writes output files and cannot be combined "
+                     "with --stdout, --stream or --incremental")
+    args.format = list(dict.fromkeys(args.format or ["text"]))
+    if args.format != ["text"] and (args.stream or args.incremental
+                                    or args.watch):
+        parser.error("--format cannot be combined with --stream, "
+                     "--incremental or --watch")
+    if args.output_dir is not None and not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    jobs = args.jobs or os.cpu_count() or 1
+    style = args.style
+    if style.endswith(".json"):
+        try:
+            style = load_style(style)
+        except (IOError, ValueError, BibTeXError) as error:
+            parser.error("citation style: {}".format(error))
+    if args.locale:
+        import locale
+        try:
+            set_collation(args.locale)
+        except locale.Error:
+            parser.error("unsupported locale '{}'".format(args.locale))
+    status = 0
+    if args.store is not None:
+        return render_store(args, style)
+    if args.watch:
+        from watch import watch
+        watch(pairs, args.output_dir, args.title, cache, style)
+        return status
+    if args.incremental:
+        from incremental import render_incremental
+
+        def render_pair(txt_path, bib_path):
+            render_incremental(txt_path, bib_path,
+                               output_path(txt_path, args.output_dir),
+                               args.title, cache, style)
+        return render_pairs(pairs, render_pair)
+    if args.stream:
+        def render_pair(txt_path, bib_path):
+            output = (sys.stdout if args.stdout
+                      else output_path(txt_path, args.output_dir))
+            with io.open(txt_path, encoding="utf-8") as txt, \
+                    open_bib(bib_path, args.mmap) as bib:
+                render_stream(txt, bib, output, args.title, cache,
+                              style=style)
+        return render_pairs(pairs, render_pair)
+    # txt_paths of each .bib file in order of first occurrence:
+    groups = {}
+    for txt_path, bib_path in pairs:
+        groups.setdefault(bib_path, []).append(txt_path)
+    if args.format != ["text"]:
+        return render_groups_formats(groups, args, cache, style)
+    for bib_path, txt_paths in groups.items():
+        if args.stdout:
+            outputs = [None] * len(txt_paths)
+        else:
+            outputs = [output_path(txt_path, args.output_dir)
+                       for txt_path in txt_paths]
+        try:
+            # .bib file is tokenized while it is read:
+            with open_bib(bib_path, args.mmap) as bib:
+                results = render_files(txt_paths, bib, outputs, args.title,
+                                       cache, jobs, style)
+        except (IOError, ValueError) as error:
+            results = [(None, u"{}".format(error))] * len(txt_paths)
+        for txt_path, (content, error) in zip(txt_paths, results):
+            if error is not None:
+                # other files are rendered nevertheless:
+                sys.stderr.write("{}: {}\n".format(txt_path, error))
+                status = 1
+            elif content is not None:
+                sys.stdout.write(content)
+    return status
+
@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+"""This module contains the benchmark suite of Bib.tXt.
+
+Synthetic .bib databases (all entry types of data/entry_types.py) and .txt
+documents (all variants of \\cite) are generated from a seed, so runs are
+comparable. Every stage of pipe() is timed for each size and the results
+are written as JSON; a second database of each size uses @string macros
+and crossref, which shows the cost of resolving them. If a baseline is
+given, stages that got slower than the tolerance allows are reported as
+regressions. Optionally, sharded parsing and the detection of
+near-duplicates (duplicates.py) are timed as well.
+
+Usage: python benchmark.py [-n 1000 10000 100000] [-o results.json]
+[--baseline benchmark_baseline.json] [--save-baseline]
+[--duplicates 200000]
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import BibtXt
+from data.entry_types import entry_types
+from data.entry_types import macros
+from data.entry_types import required
+
+default_sizes = (1000, 10000, 100000)
+default_seed = 2018
+default_repeat = 3
+default_tolerance = 0.25
+# differences below are noise (seconds):
+min_difference = 0.005
+baseline_path = "benchmark_baseline.json"
+stages = ("check_all_keys", "check_all_types", "bib_to_dict",
+          "check_required_fields", "transfer", "bibliography")
+directory = os.path.dirname(os.path.abspath(__file__))
+example = [os.path.join("xmp", "xmp.txt"), os.path.join("xmp", "xmp.bib"),
+           "--stdout"]
+# cold-start commands; python is the start-up time of the interpreter:
+startup_commands = {"python": ["-c", "pass"],
+                    "import": ["-c", "import BibtXt"],
+                    "cli": ["-m", "BibtXt"] + example,
+                    "script": ["BibtXt.py"] + example}
+
+surnames = ["Arendt", "Goethe", "Borchelt", "Schlangen", "Müller", "Smith",
+            "Nakamura", "O'Neil", "Østergaard", "Harder", "Lovelace",
+            "Turing", "Hopper", "Knuth", "Dijkstra", "Liskov"]
+forenames = ["Anna", "Johann Wolfgang", "Ben", "David", "Jürgen", "Jane",
+             "Haruki", "Max", "Ada", "Alan", "Grace", "Donald", "Barbara"]
+particles = ["von", "van der", "de la"]
+words = ["theory", "of", "the", "history", "language", "computation",
+         "Faust", "tragedy", "analysis", "notes", "on", "introduction",
+         "programming", "structure", "science", "art", "Bielefeld"]
+# values of fields other than names, title and year:
+values = {"journal": "Journal of {}", "volume": "{}", "publisher": "{} Press",
+          "booktitle": "Proceedings of {}", "chapter": "{}",
+          "pages": "{}--{}", "school": "University of {}",
+          "institution": "Institute of {}", "note": "Note on {}",
+          "number": "{}", "address": "{}", "month": "{}",
+          "series": "Series {}", "edition": "{}", "howpublished": "{}",
+          "organization": "{} Society", "type": "{}", "key": "{}",
+          "url": "https://example.org/{}"}
+cite_variants = (u"\\cite{{{key}}}", u"\\cite[{suffix}]{{{key}}}",
+                 u"\\cite[{prefix}][]{{{key}}}",
+                 u"\\cite[{prefix}][{suffix}]{{{key}}}")
+
+
+def random_name(rng):
+    """Return random name in one of the formats of BibTeX."""
+    surname = rng.choice(surnames)
+    forename = rng.choice(forenames)
+    form = rng.randrange(10)
+    if form == 0:
+        return u"{} {} {}".format(forename, rng.choice(particles), surname)
+    if form == 1:
+        return u"{} {}, Jr, {}".format(rng.choice(particles), surname,
+                                       forename)
+    if form == 2:
+        return u"{{{} and Sons}}".format(surname)
+    return u"{}, {}".format(surname, forename)
+
+
+def random_value(rng, field):
+    """Return random value of field."""
+    if field in BibtXt.name_fields:
+        return u" and ".join(random_name(rng)
+                             for _ in range(rng.choice((1, 1, 2, 3, 5))))
+    if field == "title":
+        return u" ".join(rng.choice(words)
+                         for _ in range(rng.randint(2, 8))).capitalize()
+    if field == "year":
+        return str(rng.randint(1800, 2020))
+    if field == "pages":
+        first = rng.randint(1, 500)
+        return values[field].format(first, first + rng.randint(1, 40))
+    if field in ("volume", "chapter", "number", "edition"):
+        return values[field].format(rng.randint(1, 99))
+    return values.get(field, u"{}").format(rng.choice(words).capitalize())
+
+
+def generate_bib(size, seed=default_seed):
+    """Return content of .bib file with size entries.
+
+    Entry types are used in turn and all required fields are given.
+    Values are enclosed in braces or quotes or given bare.
+
+    size -- number of entries
+    seed -- seed of random generator (default default_seed)
+    """
+    rng = random.Random(seed)
+    types = sorted(entry_types)
+    chunks = []
+    for number in range(size):
+        mytype = types[number % len(types)]
+        needed = [rng.choice(alternatives)
+                  for alternatives in required[mytype]]
+        optional = [field.split("/")[0] for field
+                    in sorted(entry_types[mytype]["optional"])
+                    if rng.random() < 0.2]
+        lines = [u"@{}{{{},".format(mytype.upper() if number % 7 == 0
+                                    else mytype, key_name(number))]
+        for field in dict.fromkeys(needed + optional):
+            value = random_value(rng, field)
+            if field in ("year", "volume") and rng.random() < 0.5:
+                lines.append(u"  {} = {},".format(field, value))
+            elif field not in BibtXt.name_fields and rng.random() < 0.3:
+                lines.append(u"  {} = \"{}\",".format(field, value))
+            else:
+                lines.append(u"  {} = {{{}}},".format(field, value))
+        lines.append(u"}\n\n")
+        chunks.append(u"\n".join(lines))
+    return u"".join(chunks)
+
+
+def generate_macro_bib(size, seed=default_seed):
+    """Return content of .bib file with size entries using macros.
+
+    Articles give their journal and month as @string macros (journals
+    refer to further macros); inproceedings cross-reference one of
+    size // 100 proceedings, whose title is their booktitle. Keys are the
+    ones of generate_bib().
+
+    size -- number of articles and inproceedings
+    seed -- seed of random generator (default default_seed)
+    """
+    rng = random.Random(seed)
+    months = sorted(macros)
+    chunks = [u"@string{{w{} = \"{}\"}}\n".format(number, word.capitalize())
+              for number, word in enumerate(words)]
+    chunks.extend(u"@string{{j{0} = \"Journal of \" # w{0}}}\n".format(number)
+                  for number in range(len(words)))
+    parents = max(size // 100, 1)
+    for number in range(size):
+        lines = [u"",
+                 u"  author = {{{}}},".format(random_value(rng, "author")),
+                 u"  title = {{{}}},".format(random_value(rng, "title"))]
+        if number % 2:
+            lines[0] = u"@article{{{},".format(key_name(number))
+            lines.append(u"  journal = j{},".format(rng.randrange(len(words))))
+            lines.append(u"  year = {},".format(random_value(rng, "year")))
+            lines.append(u"  volume = {},".format(random_value(rng,
+                                                              "volume")))
+            lines.append(u"  month = {}".format(rng.choice(months)))
+        else:
+            lines[0] = u"@inproceedings{{{},".format(key_name(number))
+            lines.append(u"  pages = {{{}}},".format(random_value(rng,
+                                                                "pages")))
+            lines.append(u"  crossref = {{Proc{}}}".format(
+                rng.randrange(parents)))
+        lines.append(u"}\n\n")
+        chunks.append(u"\n".join(lines))
+    for number in range(parents):
+        chunks.append(u"@proceedings{{Proc{},\n  editor = {{{}}},\n"
+                      u"  title = \"Proceedings of \" # w{},\n"
+                      u"  year = {},\n  publisher = w{} # \" Press\"\n}}\n\n"
+                      .format(number, random_value(rng, "editor"),
+                              rng.randrange(len(words)),
+                              random_value(rng, "year"),
+                              rng.randrange(len(words))))
+    return u"".join(chunks)
+
+
+def key_name(number):
+    """Return BibTeX key of entry number."""
+    return u"Key{}".format(number)
+
+
+def generate_txt(keys, size, seed=default_seed):
+    """Return content of .txt file with size citations of keys.
+
+    All variants of \\cite are used in turn.
+
+    keys -- number of entries in .bib file
+    size -- number of citations
+    seed -- seed of random generator (default default_seed)
+    """
+    rng = random.Random(seed + 1)
+    chunks = []
+    for number in range(size):
+        sentence = u" ".join(rng.choice(words)
+                             for _ in range(rng.randint(4, 20)))
+        cite = cite_variants[number % len(cite_variants)].format(
+            key=key_name(rng.randrange(keys)), prefix=u"cf.",
+            suffix=u"p. {}".format(rng.randint(1, 300)))
+        chunks.append(u"{} {}.".format(sentence.capitalize(), cite))
+        chunks.append(u"\n\n" if number % 5 == 4 else u" ")
+    return u"".join(chunks)
+
+
+def time_stages(txt, bib, repeat=default_repeat):
+    """Return dict of stages of pipe() and their best time in seconds.
+
+    Like timeit, garbage collection is disabled while timing.
+    """
+    best = dict.fromkeys(stages, float("inf"))
+    for _ in range(repeat):
+        # names of previous runs must not be cached:
+        BibtXt.parse_names.cache_clear()
+        gc.collect()
+        gc.disable()
+        try:
+            timings = run_stages(txt, bib)
+        finally:
+            gc.enable()
+        for stage, seconds in timings.items():
+            best[stage] = min(best[stage], seconds)
+    best["total"] = sum(best[stage] for stage in stages)
+    return best
+
+
+def run_stages(txt, bib):
+    """Run stages of pipe() once and return dict of their times."""
+    example = BibtXt.BibTeX(txt, bib, None, u"Bibliography")
+    timings = {}
+    start = time.perf_counter()
+    key_not_in_txt = example.check_all_keys()
+    timings["check_all_keys"] = time.perf_counter() - start
+    start = time.perf_counter()
+    example.check_all_types()
+    timings["check_all_types"] = time.perf_counter() - start
+    start = time.perf_counter()
+    basis_dict = example.bib_to_dict(key_not_in_txt)
+    timings["bib_to_dict"] = time.perf_counter() - start
+    start = time.perf_counter()
+    key_type_dict = example.check_required_fields(basis_dict)
+    timings["check_required_fields"] = time.perf_counter() - start
+    start = time.perf_counter()
+    example.transfer(basis_dict)
+    timings["transfer"] = time.perf_counter() - start
+    start = time.perf_counter()
+    example.bibliography(basis_dict, key_type_dict)
+    timings["bibliography"] = time.perf_counter() - start
+    return timings
+
+
+def time_startup(repeat=10):
+    """Return dict of cold-start commands and their best time in seconds.
+
+    Every command runs in a new interpreter; a first run writes the
+    compiled modules, as after installation.
+    """
+    environment = dict(os.environ)
+    environment.pop("PYTHONDONTWRITEBYTECODE", None)
+    best = {}
+    for name, arguments in startup_commands.items():
+        command = [sys.executable] + arguments
+        subprocess.run(command, cwd=directory, env=environment, check=True,
+                       stdout=subprocess.DEVNULL)
+        best[name] = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=directory, env=environment,
+                           check=True, stdout=subprocess.DEVNULL)
+            best[name] = min(best[name], time.perf_counter() - start)
+    return best
+
+
+def time_parse_jobs(size, jobs, seed=default_seed):
+    """Return dict of numbers of jobs and seconds of parsing a .bib file.
+
+    The .bib file of size entries is parsed in shards (cf. shards.py);
+    shards are made small enough that every job gets one.
+    """
+    import shards
+    bib = generate_bib(size, seed)
+    timings = {}
+    with tempfile.NamedTemporaryFile("w", suffix=".bib", encoding="utf-8",
+                                     delete=False) as file:
+        file.write(bib)
+    min_shard_size = shards.min_shard_size
+    shards.min_shard_size = len(bib.encode("utf-8")) // max(jobs) or 1
+    try:
+        for number in jobs:
+            start = time.perf_counter()
+            shards.parse_parallel(file.name, number)
+            timings[str(number)] = time.perf_counter() - start
+    finally:
+        shards.min_shard_size = min_shard_size
+        os.remove(file.name)
+    return timings
+
+
+def time_duplicates(size, seed=default_seed, repeat=default_repeat):
+    """Return results of finding near-duplicates in a .bib file as dict.
+
+    Every 100th entry of generate_bib(size) is added again under another
+    key and with its title in upper case; "found" is the number of these
+    copies clustered with their original. "find_duplicates" is the best
+    time in seconds; unlike time_stages(), garbage collection stays
+    enabled, as for callers of duplicates.find_duplicates().
+    """
+    import duplicates
+    entries = BibtXt.parse_entries(generate_bib(size, seed))
+    copies = []
+    for mytype, key, field_dict in entries[::100]:
+        field_dict = dict(field_dict)
+        if "title" in field_dict:
+            field_dict["title"] = field_dict["title"].upper()
+        copies.append((mytype, key + u"Copy", field_dict))
+    entries.extend(copies)
+    best = float("inf")
+    for _ in range(repeat):
+        # names of previous runs must not be cached:
+        BibtXt.parse_names.cache_clear()
+        gc.collect()
+        start = time.perf_counter()
+        clusters, compared = duplicates.find_duplicates(entries)
+        best = min(best, time.perf_counter() - start)
+    # {key: number of cluster}
+    cluster_of = {record.key: number
+                  for number, (records, _) in enumerate(clusters)
+                  for record in records}
+    found = sum(1 for _, key, _ in copies if key in cluster_of
+                and cluster_of[key] == cluster_of.get(key[:-len(u"Copy")]))
+    return {"entries": len(entries), "copies": len(copies), "found": found,
+            "clusters": len(clusters), "compared": compared,
+            "find_duplicates": best}
+
+
+def run_benchmarks(sizes=default_sizes, seed=default_seed,
+                   repeat=default_repeat, startup=True, parse_jobs=None,
+                   resolve=True, duplicates_size=None):
+    """Return results of all benchmarks as dict.
+
+    Each size is used as number of entries and number of citations.
+    startup -- also measure cold-start time (default True)
+    parse_jobs -- numbers of jobs to parse the largest .bib file with
+    (default None, i.e. not measured)
+    resolve -- also time databases with macros and crossref (default True)
+    duplicates_size -- number of entries to find near-duplicates in
+    (default None, i.e. not measured)
+    """
+    results = {"python": platform.python_version(), "seed": seed,
+               "repeat": repeat, "sizes": {}}
+    if resolve:
+        results["resolve"] = {}
+    if startup:
+        results["startup"] = time_startup()
+    if parse_jobs:
+        results["parse_jobs"] = time_parse_jobs(max(sizes), parse_jobs, seed)
+    if duplicates_size:
+        results["duplicates"] = time_duplicates(duplicates_size, seed, repeat)
+    for size in sizes:
+        bib = generate_bib(size, seed)
+        txt = generate_txt(size, size, seed)
+        results["sizes"][str(size)] = time_stages(txt, bib, repeat)
+        if resolve:
+            results["resolve"][str(size)] = time_stages(
+                txt, generate_macro_bib(size, seed), repeat)
+    return results
+
+
+def compare(results, baseline, tolerance=default_tolerance):
+    """Return list of regressions of results against baseline.
+
+    A regression is (size, stage, baseline seconds, seconds) of a stage
+    that is more than tolerance (fraction) slower than in the baseline.
+    size is "startup" for cold-start commands, "resolve SIZE" for
+    databases with macros and crossref and "duplicates SIZE" for finding
+    near-duplicates (if the baseline has the same number of entries).
+    """
+    regressions = []
+    # (size, timings, timings of baseline):
+    timings_of_sizes = [
+        (size, timings, baseline.get("sizes", {}).get(size, {}))
+        for size, timings in sorted(results["sizes"].items(),
+                                    key=lambda item: int(item[0]))]
+    timings_of_sizes.extend(
+        (u"resolve " + size, timings,
+         baseline.get("resolve", {}).get(size, {}))
+        for size, timings in sorted(results.get("resolve", {}).items(),
+                                    key=lambda item: int(item[0])))
+    if "startup" in results:
+        timings_of_sizes.append(("startup", results["startup"],
+                                 baseline.get("startup", {})))
+    if "duplicates" in results:
+        old = baseline.get("duplicates", {})
+        if old.get("entries") == results["duplicates"]["entries"]:
+            timings_of_sizes.append((
+                u"duplicates {}".format(results["duplicates"]["entries"]),
+                {"find_duplicates": results["duplicates"]["find_duplicates"]},
+                old))
+    for size, timings, old in timings_of_sizes:
+        for stage, seconds in timings.items():
+            if stage not in old:
+                continue
+            if (seconds > old[stage] * (1 + tolerance)
+               and seconds - old[stage] > min_difference):
+                regressions.append((size, stage, old[stage], seconds))
+    return regressions
+
+
+def main(argv=None):
+    """Run benchmarks from the command line.
+
+    Return exit status (1 if regressions were detected).
+    """
+    parser = argparse.ArgumentParser(
+        description="Time the stages of Bib.tXt on synthetic input.")
+    parser.add_argument("-n", "--sizes", type=int, nargs="+",
+                        default=list(default_sizes),
+                        help="numbers of entries and citations "
+                             "(default: 1000 10000 100000)")
+    parser.add_argument("-r", "--repeat", type=int, default=default_repeat,
+                        help="runs per size; the best time is kept "
+                             "(default: 3)")
+    parser.add_argument("--seed", type=int, default=default_seed)
+    parser.add_argument("--no-startup", action="store_true",
+                        help="do not measure cold-start time")
+    parser.add_argument("--no-resolve", action="store_true",
+                        help="do not time databases with @string macros "
+                             "and crossref")
+    parser.add_argument("-j", "--parse-jobs", type=int, nargs="+",
+                        help="also time sharded parsing of the largest "
+                             ".bib file with these numbers of jobs, "
+                             "e.g. 1 2 4 8")
+    parser.add_argument("--duplicates", type=int, metavar="SIZE",
+                        help="also time finding near-duplicates in a .bib "
+                             "file of SIZE entries, e.g. 200000")
+    parser.add_argument("-o", "--output",
+                        help="write results as JSON to this file")
+    parser.add_argument("--baseline", default=baseline_path,
+                        help="baseline to compare against (default: "
+                             "benchmark_baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store results as new baseline")
+    parser.add_argument("--tolerance", type=float, default=default_tolerance,
+                        help="allowed slowdown as fraction (default: 0.25)")
+    args = parser.parse_args(argv)
+    results = run_benchmarks(args.sizes, args.seed, args.repeat,
+                             not args.no_startup, args.parse_jobs,
+                             not args.no_resolve, args.duplicates)
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with io.open(args.output, mode="w", encoding="utf-8") as file:
+            file.write(report + u"\n")
+    else:
+        print(report)
+    if args.save_baseline:
+        with io.open(args.baseline, mode="w", encoding="utf-8") as file:
+            file.write(report + u"\n")
+        return 0
+    try:
+        with io.open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+    except (IOError, ValueError):
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for size, stage, old, new in regressions:
+        if size == "startup":
+            where = "cold start"
+        elif size.startswith("resolve "):
+            where = "{} entries with macros and crossref".format(
+                size.split()[1])
+        elif size.startswith("duplicates "):
+            where = "near-duplicates of {} entries".format(size.split()[1])
+        else:
+            where = "{} entries".format(size)
+        sys.stderr.write("Regression: {} at {} took {:.4f} s "
+                         "(baseline {:.4f} s).\n".format(stage, where, new,
+                                                         old))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
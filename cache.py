@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""This module contains the class BibCache.
+
+Parsed .bib files are stored on disk as JSON lists of [type, key,
+fields]. Unlike pickle, loading JSON cannot run code, so a directory
+shared by several users ($BIBTXT_CACHE_DIR) is safe to read. File names
+are derived from the content hash of the .bib file and the version of
+the parser, so changes of either invalidate old entries. The cache is
+bounded in size; least recently used files are removed first.
+"""
+import hashlib
+import io
+import json
+import os
+
+default_max_size = 256 * 1024 * 1024
+suffix = ".json"
+
+
+def file_digest(path):
+    """Return hex digest of content of file at path (read in chunks)."""
+    sha = hashlib.sha256()
+    with io.open(path, mode="rb") as file:
+        for chunk in iter(lambda: file.read(1 << 16), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class BibCache(object):
+    """Store parsed .bib files in a directory."""
+
+    def __init__(self, directory, max_size=default_max_size):
+        """Initialize an instance of the class.
+
+        directory -- cache directory (created if missing)
+        max_size -- maximum size of all cache files in bytes (default
+        default_max_size)
+        """
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def digest(self, bib, version):
+        """Return hex digest of .bib content and parser version.
+
+        Files are hashed as bytes (cf. file_digest()) without decoding
+        them; other file objects are read and rewound afterwards.
+
+        bib -- content of .bib file or file object
+        version -- version of the parser
+        """
+        if isinstance(bib, str):
+            content = hashlib.sha256(bib.encode("utf-8")).hexdigest()
+        elif isinstance(getattr(bib, "name", None), str):
+            content = file_digest(bib.name)
+        else:
+            content = hashlib.sha256(bib.read().encode("utf-8")).hexdigest()
+            bib.seek(0)
+        return hashlib.sha256(u"{}\n{}".format(version, content).encode(
+            "utf-8")).hexdigest()
+
+    def path(self, digest):
+        """Return path of cache file for digest."""
+        return os.path.join(self.directory, digest + suffix)
+
+    def get(self, digest):
+        """Return cached entries for digest or None if not cached."""
+        path = self.path(digest)
+        try:
+            with io.open(path, encoding="utf-8") as file:
+                entries = [(mytype, key, field_dict)
+                           for mytype, key, field_dict in json.load(file)]
+        except (IOError, ValueError, TypeError):
+            return None
+        # mark as recently used:
+        os.utime(path, None)
+        return entries
+
+    def put(self, digest, entries):
+        """Store entries for digest and evict old files if necessary."""
+        path = self.path(digest)
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with io.open(temporary, mode="w", encoding="utf-8") as file:
+            json.dump(entries, file, ensure_ascii=False,
+                      separators=(",", ":"))
+        os.replace(temporary, path)
+        self.evict()
+
+    def files(self):
+        """Return list of (mtime, size, path) of all cache files."""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(suffix):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self):
+        """Remove least recently used files until max_size is kept."""
+        files = sorted(self.files())
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def invalidate(self, digest=None):
+        """Remove cache file for digest or all cache files if None."""
+        paths = ([self.path(digest)] if digest is not None
+                 else [path for _, _, path in self.files()])
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
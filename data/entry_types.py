@@ -2,8 +2,13 @@
 """This module contains information on entry types.
 
 Contains a dict with all valid entry types and their required and optional
-fields, a set of possible fields and a list of valid entry types.
+fields, a set of possible fields, a set of valid entry types and a dict of
+the required fields of each type as tuples of alternatives and the
+@string macros predefined by BibTeX (the months). The lookup structures
+are frozen, so they are computed once and cannot be changed by accident.
 """
+from types import MappingProxyType
+
 entry_types = {"article":
                {"required": {"author", "title", "journal", "year", "volume"},
                 "optional": {"number", "pages", "month", "note", "key"}},
@@ -62,8 +67,20 @@ entry_types = {"article":
                "unpublished":
                {"required": {"author", "title", "note"},
                 "optional": {"month", "year", "key"}}}
-fields = {"address", "annote", "author", "booktitle", "chapter", "crossref",
-          "edition", "editor", "howpublished", "institution", "journal", "key",
-          "month", "note", "number", "organization", "pages", "publisher",
-          "school", "series", "title", "type", "volume", "year"}
-types = list(entry_types.keys())
+fields = frozenset({"address", "annote", "author", "booktitle", "chapter",
+                    "crossref", "edition", "editor", "howpublished",
+                    "institution", "journal", "key", "month", "note",
+                    "number", "organization", "pages", "publisher", "school",
+                    "series", "title", "type", "volume", "year"})
+types = frozenset(entry_types)
+# required: {type: (("author", "editor"), ("title",) etc.)}
+required = MappingProxyType({mytype: tuple(tuple(needed.split("/"))
+                                           for needed
+                                           in sorted(value["required"]))
+                             for mytype, value in entry_types.items()})
+# macros: {"jan": "January" etc.}
+macros = MappingProxyType({month[:3].lower(): month for month
+                           in ("January", "February", "March", "April",
+                               "May", "June", "July", "August",
+                               "September", "October", "November",
+                               "December")})
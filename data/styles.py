@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""This module contains the citation styles of reference-list entries.
+
+A style is a dict of entry types and lists of templates. For each entry
+the first template whose placeholders are all given is used; entries
+without such a template are formatted with the default style.
+Placeholders are the fields of the entry plus authors and author
+("surname, forename and surname, forename"), surname and forename of the
+first author (authors, author and forename only if an author is given).
+editor ("surname, forename" of all editors) and title default to "n.a.".
+"""
+styles = {"default":
+          {"article":
+           ["{authors} ({year}): {title}. In: {journal} {volume}."],
+           "book":
+           ["{authors}; ed. {editor} ({year}): {title}. {publisher}.",
+            "{surname}; ed. {editor} ({year}): {title}. {publisher}."],
+           "booklet":
+           ["{authors} ({year}): {title}.",
+            "{surname} ({year}): {title}."],
+           "conference":
+           ["{authors} ({year}): {title}. In: {booktitle}."],
+           "inbook":
+           ["{authors}; ed. {editor} ({year}): {title}, chapter {chapter}, "
+            "pages {pages}. {publisher}.",
+            "{authors}; ed. {editor} ({year}): {title}, chapter {chapter}. "
+            "{publisher}.",
+            "{authors}; ed. {editor} ({year}): {title}, pages {pages}. "
+            "{publisher}.",
+            "{surname}; ed. {editor} ({year}): {title}, chapter {chapter}, "
+            "pages {pages}. {publisher}.",
+            "{surname}; ed. {editor} ({year}): {title}, chapter {chapter}. "
+            "{publisher}.",
+            "{surname}; ed. {editor} ({year}): {title}, pages {pages}. "
+            "{publisher}."],
+           "incollection":
+           ["{authors} ({year}): {title}. In: {publisher}, {booktitle}."],
+           "inproceedings":
+           ["{authors} ({year}): {title}. In: {booktitle}."],
+           "manual":
+           ["{authors} ({year}): {title}.",
+            "{surname} ({year}): {title}."],
+           "mastersthesis":
+           ["{authors} ({year}): {title}. Master's thesis, {school}."],
+           "misc":
+           ["{authors} ({year}): {title}.",
+            "{surname} ({year}): {title}."],
+           "phdthesis":
+           ["{authors} ({year}): {title}. PhD thesis, {school}."],
+           "proceedings":
+           ["{authors}; ed. {editor} ({year}): {title}.",
+            "{surname}; ed. {editor} ({year}): {title}."],
+           "techreport":
+           ["{authors} ({year}): {title}. {institution}."],
+           "unpublished":
+           ["{authors}: {title}. {note}."]}}
@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""This module contains the detection of near-duplicate entries.
+
+Merged .bib files often contain the same work several times, under
+different keys and with small differences (case, accents, LaTeX,
+punctuation, a changed word, the format of names). Comparing all pairs of
+entries is quadratic, so entries are put into blocks and only entries
+sharing a block are compared:
+
+- Pairs of the three rarest words of the normalized title (rarest in the
+  .bib file). Titles differing in case, accents, LaTeX, punctuation or
+  one word share a pair, unrelated titles rarely do.
+- The surname of the first author (or editor) and the year.
+
+Blocks of more than max_block_size entries (e.g. a common surname) are
+sorted by title and every entry is only compared with the next window
+entries. Candidates are scored by the similarity of title (character
+trigrams), surnames and year; entries whose score reaches the threshold
+are joined into clusters. Pairs that cannot reach the threshold whatever
+their trigrams are left out first (cf. max_similarity()).
+
+Usage: python duplicates.py refs.bib [-t THRESHOLD] [--json]
+"""
+import argparse
+import io
+import itertools
+import json
+import re
+import sys
+from collections import Counter
+
+import BibtXt
+
+default_threshold = 0.8
+# weights of the similarity of title, surnames and year (sum 1):
+title_weight = 0.6
+names_weight = 0.3
+year_weight = 0.1
+# number of rarest words of a title whose pairs are block keys:
+rare_words = 3
+# blocks up to this size are compared completely, larger ones by window:
+max_block_size = 20
+window = 10
+re_word = re.compile(r"\w+")
+
+
+class Record(object):
+    """Entry of .bib file prepared for comparison."""
+
+    __slots__ = ("index", "key", "type", "title", "year", "title_key",
+                 "words", "names", "surnames", "mask", "size", "shingles")
+
+    def __init__(self, index, key, mytype, field_dict, names):
+        """Initialize an instance of the class.
+
+        index -- position of entry in .bib file (0 for first entry)
+        key -- BibTeX key
+        mytype -- entry type
+        field_dict -- fields with macros expanded
+        names -- tuple of surnames (primary collation keys) of authors
+        (or editors) in order of the entry
+        """
+        self.index = index
+        self.key = key
+        self.type = mytype
+        self.title = field_dict.get("title", u"")
+        self.year = field_dict.get("year", BibtXt.no_year)
+        self.title_key = u" ".join(
+            re_word.findall(BibtXt.collation_key(self.title)[0]))
+        self.words = frozenset(self.title_key.split())
+        self.names = names
+        self.surnames = frozenset(names)
+        # surnames hashed to 64 bits (no common bit, no common surname):
+        self.mask = 0
+        for name in self.surnames:
+            self.mask |= 1 << (hash(name) & 63)
+        # number of character trigrams of title, cf. max_similarity():
+        self.size = len(trigrams(self.title_key))
+        # character trigrams of title, cf. title_shingles():
+        self.shingles = None
+
+    def __repr__(self):
+        """Return representation of the instance."""
+        return "Record({!r}, {!r})".format(self.index, self.key)
+
+
+def prepare(entries):
+    """Return list of Record of all entries (but @string and @preamble).
+
+    @string macros are expanded as when rendering; crossref fields are not
+    resolved, since duplicates are compared by their own fields.
+
+    entries -- list of entries returned by BibtXt.iter_entries()
+    """
+    example = BibtXt.BibTeX(u"", entries)
+    # collect the macros without keeping any entry:
+    example.read_bib(())
+    # names of authors (or editors) as for Record, which often repeat:
+    names_of = {}
+    records = []
+    for mytype, key, field_dict in entries:
+        if not key and mytype.lower() in BibtXt.macro_types:
+            continue
+        field_dict = example.expand_fields(field_dict)
+        persons = field_dict.get("author") or field_dict.get("editor", u"")
+        names = names_of.get(persons)
+        if names is None:
+            names = names_of[persons] = tuple(
+                BibtXt.collation_key(person.surname)[0]
+                for person in BibtXt.parse_names(persons))
+        records.append(Record(len(records), key, mytype, field_dict, names))
+    return records
+
+
+def title_blocks(records):
+    """Return list of block keys of titles of records.
+
+    The keys of a title are the pairs of its rare_words rarest words (the
+    rarest word, if it has one word only). Titles differing in one word
+    still share a pair, while common words (e.g. "the", "of") hardly form
+    keys.
+    """
+    frequency = Counter(word for record in records for word in record.words)
+    # rank of words, rarest first (ties in alphabetical order):
+    rank = {word: number for number, word in enumerate(sorted(
+        frequency, key=lambda word: (frequency[word], word)))}
+    result = []
+    for record in records:
+        rarest = sorted(record.words, key=rank.__getitem__)[:rare_words]
+        if len(rarest) == 1:
+            result.append(rarest)
+        else:
+            result.append([u" ".join(pair) for pair
+                           in itertools.combinations(rarest, 2)])
+    return result
+
+
+def blocks(records):
+    """Return dict of blocks: {block key: list of indices of records}.
+
+    Keys are the pairs of rare words of the title as strings (cf.
+    title_blocks()) and (surname of first author, year) as tuples.
+    """
+    result = {}
+    for record, keys in zip(records, title_blocks(records)):
+        for key in keys:
+            result.setdefault(key, []).append(record.index)
+        if record.names:
+            result.setdefault((record.names[0], record.year),
+                              []).append(record.index)
+    return result
+
+
+def candidates(records, block_dict, threshold=0.0):
+    """Return set of pairs of indices of records to compare.
+
+    All pairs of a block are compared unless the block has more than
+    max_block_size entries; then it is sorted by title and surnames and
+    every entry is paired with the next window entries. Pairs whose score
+    cannot reach threshold are left out (cf. max_similarity()).
+
+    A pair (i, j), i < j, is given as the integer i * len(records) + j:
+    unlike tuples, integers are not tracked by the garbage collector.
+    """
+    count = len(records)
+    # similarity() rounds to three decimals:
+    threshold -= 0.0005
+    # most pairs of large blocks have no common surname; whether these
+    # can reach threshold only depends on their years (cf. similarity()):
+    masks = [record.mask for record in records]
+    years = [record.year for record in records]
+    reachable = [title_weight + year_weight * same >= threshold
+                 for same in (False, True)]
+    pairs = set()
+    for indices in block_dict.values():
+        if len(indices) < 2:
+            continue
+        if len(indices) <= max_block_size:
+            # indices are in ascending order:
+            block_pairs = itertools.combinations(indices, 2)
+        else:
+            indices = sorted(indices, key=lambda index: (
+                records[index].title_key, records[index].names))
+            block_pairs = ((first, second) for position, first
+                           in enumerate(indices) for second
+                           in indices[position + 1:position + 1 + window])
+        for first, second in block_pairs:
+            if (not masks[first] & masks[second]
+                    and (masks[first] or masks[second])
+                    and not reachable[years[first] == years[second]]):
+                continue
+            pair = (first * count + second if first < second
+                    else second * count + first)
+            if pair not in pairs and max_similarity(
+                    records[first], records[second]) >= threshold:
+                pairs.add(pair)
+    return pairs
+
+
+def trigrams(text):
+    """Return set of character trigrams of text (or {text} if shorter)."""
+    return (frozenset(text[start:start + 3] for start in range(len(text) - 2))
+            or frozenset((text,)))
+
+
+def title_shingles(record):
+    """Return (memoized) set of character trigrams of normalized title."""
+    if record.shingles is None:
+        record.shingles = trigrams(record.title_key)
+    return record.shingles
+
+
+def title_similarity(first, second):
+    """Return Jaccard similarity of character trigrams of titles of records.
+
+    Titles without a common word count as different, so the trigrams of
+    most candidates of a (surname, year) block are not needed.
+    """
+    if first.words.isdisjoint(second.words) and (first.words
+                                                  or second.words):
+        return 0.0
+    return jaccard(title_shingles(first), title_shingles(second))
+
+
+def jaccard(first, second):
+    """Return Jaccard similarity of two sets (1.0 if both are empty)."""
+    if not first and not second:
+        return 1.0
+    common = len(first & second)
+    return common / (len(first) + len(second) - common)
+
+
+def max_similarity(first, second):
+    """Return upper bound of similarity() of two instances of Record.
+
+    The Jaccard similarity of two sets is at most the ratio of their
+    sizes, so the trigrams of the titles are not compared. The bound is
+    not rounded.
+    """
+    if first.surnames.isdisjoint(second.surnames):
+        names = 0.0 if first.surnames or second.surnames else 1.0
+    else:
+        names = jaccard(first.surnames, second.surnames)
+    score = names_weight * names + year_weight * (first.year == second.year)
+    if not first.words.isdisjoint(second.words) or not (first.words
+                                                        or second.words):
+        score += (title_weight * min(first.size, second.size)
+                  / max(first.size, second.size))
+    return score
+
+
+def similarity(first, second):
+    """Return similarity of two instances of Record between 0 and 1.
+
+    The score is rounded to three decimals, so it compares with the
+    threshold as shown.
+    """
+    score = (title_weight * title_similarity(first, second)
+             + names_weight * jaccard(first.surnames, second.surnames)
+             + year_weight * (first.year == second.year))
+    return round(score, 3)
+
+
+def find_duplicates(entries, threshold=default_threshold):
+    """Return (clusters, number of compared pairs) of likely duplicates.
+
+    Every cluster is a tuple (records, pairs): records is the list of
+    Record in order of the .bib file, pairs the list of (Record, Record,
+    score) with score >= threshold, highest score first. Clusters are
+    ordered by their first entry.
+
+    entries -- list of entries returned by BibtXt.iter_entries()
+    threshold -- minimum score of duplicates (default default_threshold)
+    """
+    records = prepare(entries)
+    pairs = candidates(records, blocks(records), threshold)
+    matches = []
+    for pair in pairs:
+        first, second = divmod(pair, len(records))
+        score = similarity(records[first], records[second])
+        if score >= threshold:
+            matches.append((records[first], records[second], score))
+    return join_clusters(len(records), matches), len(pairs)
+
+
+def join_clusters(count, matches):
+    """Return clusters of matches (cf. find_duplicates()).
+
+    count -- number of records
+    matches -- list of (Record, Record, score)
+    """
+    # union-find of indices of records:
+    parents = list(range(count))
+
+    def root(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    for first, second, _ in matches:
+        parents[root(second.index)] = root(first.index)
+    groups = {}
+    for match in matches:
+        groups.setdefault(root(match[0].index), []).append(match)
+    clusters = []
+    for group in groups.values():
+        records = {record.index: record for match in group
+                   for record in match[:2]}
+        clusters.append(([records[index] for index in sorted(records)],
+                         sorted(group, key=lambda match: (
+                             -match[2], match[0].index, match[1].index))))
+    clusters.sort(key=lambda cluster: cluster[0][0].index)
+    return clusters
+
+
+def format_clusters(clusters, count, compared):
+    """Return report of clusters as text.
+
+    count -- number of entries
+    compared -- number of compared pairs
+    """
+    lines = [u"{} clusters of likely duplicates ({} entries, {} pairs "
+             u"compared).".format(len(clusters), count, compared)]
+    for number, (records, pairs) in enumerate(clusters, 1):
+        lines.append(u"")
+        lines.append(u"{}. {} entries, score {:.2f}:".format(
+            number, len(records), pairs[0][2]))
+        for record in records:
+            lines.append(u"   {} ({}, {}): {}".format(
+                record.key, record.type, record.year,
+                record.title or BibtXt.no_title))
+        for first, second, score in pairs:
+            lines.append(u"   {} ~ {}: {:.2f}".format(first.key, second.key,
+                                                       score))
+    return u"\n".join(lines) + u"\n"
+
+
+def clusters_json(clusters, count, compared):
+    """Return clusters as dict for JSON (cf. format_clusters())."""
+    return {"entries": count, "compared": compared,
+            "clusters": [{"entries": [{"key": record.key,
+                                       "type": record.type,
+                                       "year": record.year,
+                                       "title": record.title}
+                                      for record in records],
+                          "pairs": [{"keys": [first.key, second.key],
+                                     "score": round(score, 3)}
+                                    for first, second, score in pairs]}
+                         for records, pairs in clusters]}
+
+
+def main(argv=None):
+    """Report likely duplicates of .bib file and return exit status.
+
+    The exit status is 1 if duplicates were found and 2 if the .bib file
+    cannot be read.
+    """
+    parser = argparse.ArgumentParser(
+        description="Find near-duplicate entries of a .bib file.")
+    parser.add_argument("bib", help="path to .bib file")
+    parser.add_argument("-t", "--threshold", type=float,
+                        default=default_threshold,
+                        help="minimum similarity of duplicates between 0 "
+                             "and 1 (default: %(default)s)")
+    parser.add_argument("--json", action="store_true",
+                        help="write clusters as JSON")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes parsing the .bib file "
+                             "(default: %(default)s)")
+    parser.add_argument("--cache-dir",
+                        help="cache parsed .bib files in this directory")
+    args = parser.parse_args(argv)
+    cache = None
+    if args.cache_dir:
+        from cache import BibCache
+        cache = BibCache(args.cache_dir)
+    try:
+        with io.open(args.bib, encoding="utf-8") as bib:
+            entries = BibtXt.parse_entries(bib, cache, args.jobs)
+        # BibtXt.BibTeXError (e.g. macros defined by each other) is a
+        # ValueError, as is a .bib file which is not UTF-8:
+        clusters, compared = find_duplicates(entries, args.threshold)
+    except (IOError, ValueError) as error:
+        sys.stderr.write("{}: {}\n".format(args.bib, error))
+        return 2
+    count = sum(1 for mytype, key, _ in entries
+                if key or mytype.lower() not in BibtXt.macro_types)
+    if args.json:
+        json.dump(clusters_json(clusters, count, compared), sys.stdout,
+                  ensure_ascii=False, indent=2)
+        sys.stdout.write(u"\n")
+    else:
+        sys.stdout.write(format_clusters(clusters, count, compared))
+    return 1 if clusters else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""This module contains the incremental mode of Bib.tXt.
+
+A manifest next to the output file stores a content hash, the cited keys
+and the converted text of every paragraph of the .txt file, the citation
+labels, a hash of the cited entries and the reference list. On the next
+run only changed paragraphs are converted again. The .bib file is only
+parsed if it changed or new keys are cited, and the reference list is only
+rebuilt if the cited keys or their entries changed.
+"""
+import hashlib
+import io
+import json
+import os
+import re
+
+import BibtXt
+from cache import file_digest
+
+manifest_version = 1
+# paragraphs end with (and include) a blank line:
+re_paragraph = re.compile(r"(?<=\n)[ \t]*\n\s*")
+
+
+def manifest_path(output):
+    """Return path of manifest of output file."""
+    return output + ".manifest.json"
+
+
+def split_paragraphs(txt):
+    """Return list of paragraphs of txt, each including its blank lines."""
+    paragraphs, start = [], 0
+    for match in re_paragraph.finditer(txt):
+        paragraphs.append(txt[start:match.end()])
+        start = match.end()
+    if start < len(txt) or not paragraphs:
+        paragraphs.append(txt[start:])
+    return paragraphs
+
+
+def digest(text):
+    """Return hex digest of text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def entries_digest(basis_dict):
+    """Return hex digest of type and fields of cited entries."""
+    return digest(json.dumps([[key, entry.type, entry.fields] for key, entry
+                              in sorted(basis_dict.items())],
+                             sort_keys=True))
+
+
+def load_manifest(path, title, style):
+    """Return manifest at path or None if missing or not applicable."""
+    try:
+        with io.open(path, encoding="utf-8") as file:
+            manifest = json.load(file)
+    except (IOError, ValueError):
+        return None
+    if (manifest.get("version") != manifest_version
+       or manifest.get("title") != title or manifest.get("style") != style):
+        return None
+    return manifest
+
+
+def render_incremental(txt_path, bib_path, output, title=u"Bibliography",
+                       cache=None, style="default"):
+    """Render .txt file reusing unchanged parts of the previous output.
+
+    Write output file and manifest and return (content, number of
+    converted paragraphs, True if the reference list was rebuilt).
+
+    txt_path -- path to .txt file
+    bib_path -- path to .bib file
+    output -- path to output file
+    title -- title of reference list (default "Bibliography")
+    cache -- instance of cache.BibCache (default None)
+    style -- name of citation style (default "default")
+    """
+    with io.open(txt_path, encoding="utf-8") as file:
+        paragraphs = split_paragraphs(file.read())
+    bib_digest = file_digest(bib_path)
+    manifest = load_manifest(manifest_path(output), title, style)
+    if manifest is None:
+        manifest = {"bib": None, "entries": None, "labels": {},
+                    "paragraphs": [], "bibliography": None}
+    # previous: {hash of paragraph: (converted paragraph, cited keys)}
+    previous = {item[0]: (item[1], item[2])
+                for item in manifest["paragraphs"]}
+    hashes = [digest(paragraph) for paragraph in paragraphs]
+    citations = {}
+    all_keys_txt = {}
+    for paragraph_hash, paragraph in zip(hashes, paragraphs):
+        if paragraph_hash in previous:
+            keys = previous[paragraph_hash][1]
+        else:
+            citations[paragraph_hash] = list(BibtXt.iter_citations(paragraph))
+            keys = [citation[4] for citation in citations[paragraph_hash]]
+        all_keys_txt.update(dict.fromkeys(keys))
+    labels = {key: tuple(label)
+              for key, label in manifest["labels"].items()}
+    old_labels = labels
+    bibliography = manifest["bibliography"]
+    rebuilt = False
+    if (bib_digest != manifest["bib"] or bibliography is None
+       or set(all_keys_txt) != set(labels)):
+        with io.open(bib_path, encoding="utf-8") as bib:
+            example = BibtXt.BibTeX(u"", bib, None, title, cache, style)
+            basis_dict, key_type_dict = example.check_entries(all_keys_txt)
+        labels = example.cite_labels(basis_dict)
+        entries = entries_digest(basis_dict)
+        if entries != manifest["entries"] or bibliography is None:
+            bibliography = example.bibliography(basis_dict, key_type_dict)
+            rebuilt = True
+        manifest["entries"] = entries
+    # keys whose citations look different now:
+    changed = {key for key in labels if labels[key] != old_labels.get(key)}
+    example = BibtXt.BibTeX(u"", u"", None, title, style=style)
+    chunks, items, converted = [], [], 0
+    for paragraph_hash, paragraph in zip(hashes, paragraphs):
+        if paragraph_hash in previous:
+            content, keys = previous[paragraph_hash]
+            if not changed.intersection(keys):
+                chunks.append(content)
+                items.append([paragraph_hash, content, keys])
+                continue
+        if paragraph_hash not in citations:
+            citations[paragraph_hash] = list(BibtXt.iter_citations(paragraph))
+        content = example.substitute(labels, paragraph,
+                                     citations[paragraph_hash])
+        keys = list(dict.fromkeys(citation[4] for citation
+                                  in citations[paragraph_hash]))
+        previous[paragraph_hash] = (content, keys)
+        chunks.append(content)
+        items.append([paragraph_hash, content, keys])
+        converted += 1
+    chunks.append(bibliography)
+    content = u"".join(chunks)
+    with io.open(output, mode="w", encoding="utf-8") as file:
+        file.write(content)
+    manifest.update({"version": manifest_version, "title": title,
+                     "style": style, "bib": bib_digest,
+                     "labels": labels, "paragraphs": items,
+                     "bibliography": bibliography})
+    temporary = manifest_path(output) + ".tmp"
+    with io.open(temporary, mode="w", encoding="utf-8") as file:
+        json.dump(manifest, file, ensure_ascii=False)
+    os.replace(temporary, manifest_path(output))
+    return content, converted, rebuilt
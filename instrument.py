@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""This module contains the class Profiler.
+
+A profiler records wall time, CPU time and peak allocations (tracemalloc)
+of every stage of Bib.tXt as well as counts of entries, citations and
+written bytes. Stages of the same name (e.g. of several .txt files) are
+summed up. The report is a JSON document:
+
+{"wall": ..., "cpu": ..., "peak_bytes": ...,
+ "stages": {"check_all_keys": {"calls": ..., "wall": ..., "cpu": ...,
+                               "peak_bytes": ...}, ...},
+ "counts": {"documents": ..., "entries": ..., ...}}
+
+Times are given in seconds; peak_bytes is the largest amount of memory
+allocated during a call of the stage (tracemalloc only traces Python
+allocations).
+"""
+import contextlib
+import io
+import json
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+report_version = 1
+
+
+class Profiler(object):
+    """Record time, memory and counts of stages."""
+
+    def __init__(self, memory=True):
+        """Initialize an instance of the class.
+
+        memory -- trace allocations with tracemalloc (default True)
+        """
+        self.memory = memory
+        # True if start() started tracemalloc:
+        self.tracing = False
+        self.stages = {}
+        self.counts = Counter()
+        self.wall = self.cpu = 0.0
+
+    def start(self):
+        """Start recording."""
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def stop(self):
+        """Stop recording.
+
+        tracemalloc is only stopped if start() started it (and not e.g.
+        PYTHONTRACEMALLOC).
+        """
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.process_time() - self.cpu
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Record time and peak allocations of the enclosed code."""
+        if self.memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            record = self.stages.setdefault(name, {"calls": 0, "wall": 0.0,
+                                                   "cpu": 0.0,
+                                                   "peak_bytes": 0})
+            record["calls"] += 1
+            record["wall"] += wall
+            record["cpu"] += cpu
+            if self.memory:
+                peak = tracemalloc.get_traced_memory()[1] - before
+                record["peak_bytes"] = max(record["peak_bytes"], peak)
+
+    def count(self, name, number=1):
+        """Add number to count of name."""
+        self.counts[name] += number
+
+    def report(self):
+        """Return report as dict."""
+        return {"version": report_version, "wall": self.wall, "cpu": self.cpu,
+                "peak_bytes": max([record["peak_bytes"] for record
+                                   in self.stages.values()] or [0]),
+                "stages": self.stages, "counts": dict(self.counts)}
+
+    def write(self, path):
+        """Write report as JSON to path ("-": stderr)."""
+        report = json.dumps(self.report(), indent=2)
+        if path == "-":
+            sys.stderr.write(report + "\n")
+            return
+        with io.open(path, mode="w", encoding="utf-8") as file:
+            file.write(report + u"\n")
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""This module contains the class MappedBib.
+
+A mapped .bib file is memory-mapped and indexed by a sidecar file
+(refs.bib.idx) of fixed-size records (hash of key, offset, length, type),
+sorted by hash. Cited keys are looked up by binary search and only their
+entries are decoded and parsed, so memory and time depend on the number
+of citations rather than the size of the .bib file. The index is built by
+one scan of the file (without parsing fields) and rebuilt whenever the
+size or modification time of the .bib file changes. @string and @preamble
+entries are indexed with key "" (cf. MappedBib.macros()).
+"""
+import hashlib
+import io
+import mmap
+import os
+import re
+import struct
+from collections import Counter
+
+import BibtXt
+
+index_version = 3
+magic = b"BIBTXTIX"
+# magic, version, size and mtime of .bib file, records, length of types:
+header = struct.Struct("<8sIQqQI")
+# hash of key, offset and length of entry body, index of type:
+record = struct.Struct("<QQIH")
+re_entry_start = re.compile(rb"@\s*(\w+)\s*([{(])")
+re_delimiter = re.compile(rb"[{}()]")
+
+
+def key_hash(key):
+    """Return 64-bit hash of key."""
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"),
+                                          digest_size=8).digest(), "little")
+
+
+def iter_spans(data):
+    """Yield (type, key, offset, length) of entry bodies of .bib content.
+
+    The entries are delimited as by BibtXt.iter_entries(); @comment is
+    skipped, @string and @preamble have key "".
+
+    data -- content of .bib file as bytes or mmap
+    """
+    pos = 0
+    while True:
+        match = re_entry_start.search(data, pos)
+        if match is None:
+            return
+        closing = b"}" if match.group(2) == b"{" else b")"
+        start = match.end()
+        depth, end = 0, len(data)
+        for delimiter in re_delimiter.finditer(data, start):
+            char = delimiter.group()
+            if char == b"{":
+                depth += 1
+            elif char == b"}" and depth:
+                depth -= 1
+            elif char == closing and not depth:
+                end = delimiter.start()
+                break
+        pos = end + 1
+        mytype = match.group(1).decode("utf-8")
+        if mytype.lower() in BibtXt.skipped_types:
+            continue
+        if mytype.lower() in BibtXt.macro_types:
+            yield mytype, u"", start, end - start
+            continue
+        comma = data.find(b",", start, end)
+        key = data[start:end if comma == -1 else comma]
+        yield mytype, key.decode("utf-8").strip(), start, end - start
+
+
+def build_index(data, stat):
+    """Return content of index file for .bib content.
+
+    data -- content of .bib file as bytes or mmap
+    stat -- os.stat() of .bib file
+    """
+    types = {}
+    records = []
+    for mytype, key, offset, length in iter_spans(data):
+        number = types.setdefault(mytype, len(types))
+        # key "" is kept for @string and @preamble (cf. macros()); other
+        # entries without key cannot be cited:
+        if not key and mytype.lower() not in BibtXt.macro_types:
+            continue
+        records.append((key_hash(key), offset, length, number))
+    records.sort()
+    type_bytes = u"\n".join(types).encode("utf-8")
+    chunks = [header.pack(magic, index_version, stat.st_size,
+                          stat.st_mtime_ns, len(records), len(type_bytes)),
+              type_bytes]
+    chunks.extend(record.pack(*item) for item in records)
+    return b"".join(chunks)
+
+
+class MappedBib(object):
+    """Memory-mapped .bib file with index of keys.
+
+    Instances can be passed to BibTeX (and render() etc.) instead of the
+    content of a .bib file.
+    """
+
+    def __init__(self, path, index_path=None):
+        """Initialize an instance of the class.
+
+        The index is loaded from index_path or built (and written there if
+        possible).
+
+        path -- path to .bib file
+        index_path -- path to index file (default None, i.e. path + ".idx")
+        """
+        self.path = path
+        self.index_path = index_path or path + ".idx"
+        with io.open(path, mode="rb") as file:
+            stat = os.fstat(file.fileno())
+            # empty files cannot be mapped:
+            self.data = (mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                         if stat.st_size else b"")
+        self.index = self.load_index(stat)
+        (_, _, _, _, self.count,
+         type_length) = header.unpack_from(self.index, 0)
+        types = bytes(self.index[header.size:header.size + type_length])
+        self.types = types.decode("utf-8").split(u"\n") if types else []
+        self.base = header.size + type_length
+
+    def load_index(self, stat):
+        """Return index of .bib file (mapped file or bytes)."""
+        try:
+            with io.open(self.index_path, mode="rb") as file:
+                index = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            if (index[:header.size]
+               and header.unpack_from(index, 0)[:4]
+               == (magic, index_version, stat.st_size, stat.st_mtime_ns)):
+                return index
+            index.close()
+        except (OSError, ValueError, struct.error):
+            pass
+        index = build_index(self.data, stat)
+        temporary = "{}.{}.tmp".format(self.index_path, os.getpid())
+        try:
+            with io.open(temporary, mode="wb") as file:
+                file.write(index)
+            os.replace(temporary, self.index_path)
+        except OSError:
+            # index is kept in memory only:
+            pass
+        return index
+
+    def candidates(self, key):
+        """Yield (offset, length, type) of entries with hash of key."""
+        wanted = key_hash(key)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            found = record.unpack_from(
+                self.index, self.base + middle * record.size)[0]
+            if found < wanted:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self.count:
+            found, offset, length, mytype = record.unpack_from(
+                self.index, self.base + low * record.size)
+            if found != wanted:
+                return
+            yield offset, length, self.types[mytype]
+            low += 1
+
+    def lookup(self, cited):
+        """Return data of cited keys for BibTeX.read_bib().
+
+        Return (key_count, all_types, entries, names) as
+        store.BibStore.lookup(); names is empty, since names are parsed
+        with the entries.
+
+        cited -- keys cited in .txt file
+        """
+        key_count = Counter()
+        entries = {}
+        for key in cited:
+            for offset, length, mytype in self.candidates(key):
+                body = self.data[offset:offset + length].decode("utf-8")
+                found, field_dict = BibtXt.parse_body(body)
+                # different keys may have the same hash:
+                if found != key:
+                    continue
+                key_count[key] += 1
+                if key not in entries:
+                    entries[key] = (mytype, field_dict)
+        return key_count, dict.fromkeys(self.types), entries, {}
+
+    def macros(self):
+        """Return list of (type, fields) of @string and @preamble entries."""
+        return [(mytype, BibtXt.parse_macros(
+                    mytype.lower(),
+                    self.data[offset:offset + length].decode("utf-8")))
+                for offset, length, mytype in sorted(self.candidates(u""))]
+
+    def close(self):
+        """Unmap the files."""
+        for mapped in (self.data, self.index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+
+    def __enter__(self):
+        """Return the instance."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Unmap the files."""
+        self.close()
+
+    def __getstate__(self):
+        """Return paths (worker processes map the files again)."""
+        return self.path, self.index_path
+
+    def __setstate__(self, state):
+        """Map the files again."""
+        self.__init__(*state)
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""This module contains the rendering service of Bib.tXt.
+
+A small HTTP/1.1 server (TCP or Unix socket) built on asyncio:
+
+- POST /bibs with the content of a .bib file returns {"id": digest}.
+- POST /render with JSON {"txt": ..., "bib": id (or "bib_content": ...),
+  "title": ..., "style": ..., "format": ...} returns the output.
+- GET /metrics returns request counts, latencies and cache statistics.
+- GET /health returns "ok".
+
+.bib files are identified by the hash of their content; the server keeps
+the most recently used ones. Rendering runs in a pool of worker processes,
+so the event loop stays responsive; every worker keeps its own LRU of
+parsed .bib files, so a warm .bib file is not parsed again (nor sent to
+the worker: the content is only sent if the worker misses it).
+
+Usage: python server.py [--host HOST] [--port PORT] [--unix PATH] [-j JOBS]
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from collections import Counter
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+
+import BibtXt
+from shards import pool_context
+
+default_host = "127.0.0.1"
+default_port = 8765
+# maximum size of request body in bytes:
+max_body = 64 * 1024 * 1024
+# number of .bib files kept by the server and parsed by each worker:
+default_cache_size = 16
+content_types = {"text": "text/plain", "markdown": "text/markdown",
+                 "html": "text/html", "json": "application/json"}
+# parsed .bib files of this (worker) process: {digest: entries}
+parsed = OrderedDict()
+parsed_cache_size = default_cache_size
+
+
+def set_cache_size(size):
+    """Set number of parsed .bib files kept by this process."""
+    global parsed_cache_size
+    parsed_cache_size = size
+
+
+def parsed_entries(digest, bib):
+    """Return (entries, True if cached) of .bib content.
+
+    entries is None if the content is neither cached nor given.
+
+    digest -- hash of content
+    bib -- content of .bib file or None
+    """
+    entries = parsed.get(digest)
+    if entries is not None:
+        parsed.move_to_end(digest)
+        return entries, True
+    if bib is None:
+        return None, False
+    entries = list(BibtXt.iter_entries(bib))
+    parsed[digest] = entries
+    while len(parsed) > parsed_cache_size:
+        parsed.popitem(last=False)
+    return entries, False
+
+
+def render_job(digest, bib, txt, title, style, name):
+    """Render txt in a worker and return (status, content, cache hit).
+
+    Errors in .txt or .bib file are returned with status 422. If bib is
+    None and the worker has not parsed the .bib file, status is None.
+    """
+    hit = False
+    try:
+        entries, hit = parsed_entries(digest, bib)
+        if entries is None:
+            return None, None, False
+        if name == "text":
+            content = BibtXt.render(txt, entries, title, style=style)
+        else:
+            buffer = io.StringIO()
+            BibtXt.render_formats(txt, entries, {name: buffer}, title,
+                                  style=style)
+            content = buffer.getvalue()
+    except BibtXt.BibTeXError as error:
+        return HTTPStatus.UNPROCESSABLE_ENTITY, u"{}".format(error), hit
+    return HTTPStatus.OK, content, hit
+
+
+class RequestError(Exception):
+    """Invalid request; args are HTTP status and message."""
+
+
+class Server(object):
+    """Handle requests and collect metrics."""
+
+    def __init__(self, jobs=1, cache_size=default_cache_size):
+        """Initialize an instance of the class.
+
+        jobs -- number of worker processes (default 1)
+        cache_size -- number of .bib files kept (default
+        default_cache_size)
+        """
+        self.jobs = jobs
+        self.cache_size = cache_size
+        # content of .bib files: {digest: content}
+        self.bibs = OrderedDict()
+        self.routes = {"/render": ("POST", self.render),
+                       "/bibs": ("POST", self.post_bib),
+                       "/metrics": ("GET", self.get_metrics),
+                       "/health": ("GET", self.get_health)}
+        self.restarts = 0
+        # start the (forked) workers before any connection is accepted;
+        # a worker inheriting the socket of a connection would keep it
+        # open, and clients reading up to its end would wait:
+        self.start_workers()
+        self.started = time.time()
+        self.in_flight = 0
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.seconds = Counter()
+        self.max_seconds = {}
+        self.cache = Counter()
+
+    def start_workers(self):
+        """Start the pool of worker processes."""
+        self.executor = ProcessPoolExecutor(self.jobs,
+                                            mp_context=pool_context(),
+                                            initializer=set_cache_size,
+                                            initargs=(self.cache_size,))
+        self.executor.submit(set_cache_size, self.cache_size).result()
+
+    async def run_job(self, *args):
+        """Return result of render_job(*args) in a worker process.
+
+        If a worker process died (e.g. killed for its memory), the pool is
+        started again and the request is answered with 503, so later
+        requests are served.
+        """
+        executor = self.executor
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, render_job, *args)
+        except BrokenProcessPool:
+            # other requests may have started the pool again already:
+            if self.executor is executor:
+                executor.shutdown(wait=False)
+                self.start_workers()
+                self.restarts += 1
+            raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE,
+                               u"Worker process died; please retry.")
+
+    def add_bib(self, content):
+        """Keep content of .bib file and return its digest."""
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        self.bibs[digest] = content
+        self.bibs.move_to_end(digest)
+        while len(self.bibs) > self.cache_size:
+            self.bibs.popitem(last=False)
+        return digest
+
+    async def handle(self, reader, writer):
+        """Answer one HTTP request of a connection."""
+        start = time.perf_counter()
+        self.in_flight += 1
+        route = "invalid"
+        # recorded if writing the response fails unexpectedly:
+        status = HTTPStatus.INTERNAL_SERVER_ERROR
+        try:
+            try:
+                method, path, body = await read_request(reader)
+                # unknown paths share one key, so metrics stay bounded:
+                route = path if path in self.routes else "other"
+                status, content_type, payload = await self.dispatch(
+                    method, path, body)
+            except RequestError as error:
+                status, message = error.args
+                content_type, payload = "text/plain", message
+            except (ValueError, asyncio.IncompleteReadError) as error:
+                status = HTTPStatus.BAD_REQUEST
+                content_type, payload = "text/plain", u"{}".format(error)
+            except Exception as error:
+                # e.g. a bug in rendering; the server keeps serving:
+                sys.stderr.write("{}: {!r}\n".format(route, error))
+                status = HTTPStatus.INTERNAL_SERVER_ERROR
+                content_type, payload = "text/plain", u"Internal error."
+            writer.write(response(status, content_type, payload))
+            # workers started again while the connection was open (cf.
+            # run_job()) share its socket; end the response all the same:
+            if writer.can_write_eof():
+                writer.write_eof()
+            await writer.drain()
+        except ConnectionError:
+            status = None
+        finally:
+            writer.close()
+            self.in_flight -= 1
+            self.record(route, status, time.perf_counter() - start)
+
+    async def dispatch(self, method, path, body):
+        """Return (status, content type, payload) of request."""
+        if path not in self.routes:
+            raise RequestError(HTTPStatus.NOT_FOUND, u"Unknown path.")
+        allowed, handler = self.routes[path]
+        if method != allowed:
+            raise RequestError(HTTPStatus.METHOD_NOT_ALLOWED,
+                               u"Use {}.".format(allowed))
+        return await handler(body)
+
+    async def post_bib(self, body):
+        """Keep .bib file of request body."""
+        digest = self.add_bib(body.decode("utf-8"))
+        return (HTTPStatus.CREATED, "application/json",
+                json.dumps({"id": digest}))
+
+    async def render(self, body):
+        """Render .txt content of JSON request in a worker."""
+        try:
+            request = json.loads(body.decode("utf-8"))
+            txt = request["txt"]
+        except (ValueError, KeyError, TypeError):
+            raise RequestError(HTTPStatus.BAD_REQUEST,
+                               u"Expected JSON object with 'txt'.")
+        for field in ("txt", "bib", "bib_content", "title", "style",
+                      "format"):
+            if not isinstance(request.get(field, u""), str):
+                raise RequestError(HTTPStatus.BAD_REQUEST,
+                                   u"'{}' must be a string.".format(field))
+        if "bib_content" in request:
+            digest = self.add_bib(request["bib_content"])
+        else:
+            digest = request.get("bib")
+        if digest not in self.bibs:
+            raise RequestError(HTTPStatus.NOT_FOUND,
+                               u"Unknown bib; POST it to /bibs first.")
+        self.bibs.move_to_end(digest)
+        # kept, since other requests may drop it from self.bibs:
+        bib = self.bibs[digest]
+        name = request.get("format", "text")
+        if name not in content_types:
+            raise RequestError(HTTPStatus.BAD_REQUEST,
+                               u"Unknown format '{}'.".format(name))
+        args = (txt, request.get("title", u"Bibliography"),
+                request.get("style", "default"), name)
+        # the content is only sent (pickled) to a worker that misses it:
+        status, content, hit = await self.run_job(digest, None, *args)
+        if status is None:
+            status, content, hit = await self.run_job(digest, bib, *args)
+        self.cache["hits" if hit else "misses"] += 1
+        if status != HTTPStatus.OK:
+            return status, "text/plain", content
+        return status, content_types[name], content
+
+    async def get_metrics(self, body):
+        """Return metrics as JSON."""
+        return HTTPStatus.OK, "application/json", json.dumps(self.metrics())
+
+    async def get_health(self, body):
+        """Return "ok"."""
+        return HTTPStatus.OK, "text/plain", u"ok"
+
+    def record(self, route, status, seconds):
+        """Add request to metrics."""
+        self.requests[route] += 1
+        self.statuses[str(int(status)) if status else "aborted"] += 1
+        self.seconds[route] += seconds
+        self.max_seconds[route] = max(self.max_seconds.get(route, 0.0),
+                                      seconds)
+
+    def metrics(self):
+        """Return dict of metrics."""
+        return {"uptime": time.time() - self.started,
+                "in_flight": self.in_flight,
+                "requests": dict(self.requests),
+                "statuses": dict(self.statuses),
+                "seconds": {route: {"total": self.seconds[route],
+                                    "mean": (self.seconds[route]
+                                             / self.requests[route]),
+                                    "max": self.max_seconds[route]}
+                            for route in self.requests},
+                "bib_cache": {"size": len(self.bibs),
+                              "hits": self.cache["hits"],
+                              "misses": self.cache["misses"]},
+                "worker_restarts": self.restarts}
+
+    def close(self):
+        """Shut down the worker processes."""
+        self.executor.shutdown()
+
+
+async def read_request(reader):
+    """Return method, path and body of HTTP request."""
+    line = await reader.readline()
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise ValueError("Malformed request line.")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > max_body:
+        raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                           u"Request body too large.")
+    body = await reader.readexactly(length) if length else b""
+    return method, target.split("?", 1)[0], body
+
+
+def response(status, content_type, payload):
+    """Return HTTP response as bytes."""
+    body = payload.encode("utf-8")
+    status = HTTPStatus(status)
+    head = ("HTTP/1.1 {} {}\r\nContent-Type: {}; charset=utf-8\r\n"
+            "Content-Length: {}\r\nConnection: close\r\n\r\n".format(
+                status.value, status.phrase, content_type, len(body)))
+    return head.encode("latin-1") + body
+
+
+def main(argv=None):
+    """Run the server until interrupted and return exit status."""
+    parser = argparse.ArgumentParser(
+        description="Serve Bib.tXt rendering over HTTP.")
+    parser.add_argument("--host", default=default_host,
+                        help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=default_port,
+                        help="port to listen on (default: %(default)s)")
+    parser.add_argument("--unix", metavar="PATH",
+                        help="listen on Unix socket PATH instead")
+    parser.add_argument("-j", "--jobs", type=int, default=0,
+                        help="number of worker processes (0: number of "
+                             "CPUs; default: %(default)s)")
+    parser.add_argument("--cache-size", type=int, default=default_cache_size,
+                        help="number of .bib files kept (default: "
+                             "%(default)s)")
+    args = parser.parse_args(argv)
+    server = Server(args.jobs or os.cpu_count() or 1, args.cache_size)
+
+    async def serve():
+        if args.unix:
+            listener = await asyncio.start_unix_server(server.handle,
+                                                       path=args.unix)
+        else:
+            listener = await asyncio.start_server(server.handle, args.host,
+                                                  args.port)
+        async with listener:
+            await listener.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""This module contains the parallel parser of large .bib files.
+
+The file is split into byte ranges (shards) at lines starting with
+"@type{" or "@type(", the shards are parsed by a pool of worker processes
+and the results are joined in order. Every worker parses the entries
+starting in its shard; if an entry does not end within its shard, the
+boundary was not safe (e.g. "@" at the beginning of a line inside a
+value) and the file is parsed serially instead. The result is thus always
+the list of entries of a serial parse, and duplicate keys of different
+shards are reported by BibTeX.check_all_keys() as before.
+"""
+import io
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import BibtXt
+
+# smallest shard in bytes; smaller files are parsed serially:
+min_shard_size = 1 << 22
+re_boundary = re.compile(rb"\n[ \t]*@[ \t]*\w+[ \t]*[{(]")
+
+
+def shard_offsets(path, shards):
+    """Return list of offsets of at most shards byte ranges of .bib file.
+
+    The first offset is 0, the last one is the size of the file.
+    """
+    size = os.path.getsize(path)
+    offsets = [0]
+    with io.open(path, mode="rb") as file:
+        for number in range(1, shards):
+            target = max(size * number // shards, offsets[-1])
+            boundary = find_boundary(file, target)
+            if boundary is None:
+                break
+            if boundary > offsets[-1]:
+                offsets.append(boundary)
+    offsets.append(size)
+    return offsets
+
+
+def find_boundary(file, pos, size=1 << 16):
+    """Return offset of first line starting with "@type{" after pos.
+
+    Return None if there is no such line.
+    """
+    file.seek(pos)
+    # tail of previous block which might contain the beginning of a match:
+    tail = b""
+    while True:
+        block = file.read(size)
+        if not block:
+            return None
+        data = tail + block
+        match = re_boundary.search(data)
+        if match is not None:
+            return pos - len(tail) + match.start() + 1
+        tail = data[-64:]
+        pos += len(block)
+
+
+def pool_context():
+    """Return fork context of multiprocessing or None if not available.
+
+    Workers started by fork share the memory of the parent (e.g. parsed
+    entries) without copying it; elsewhere the default start method is
+    used.
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return None
+
+
+def parse_shard(path, start, end, last):
+    """Return list of entries of byte range or None if it is not safe.
+
+    path -- path to .bib file
+    start -- offset of first byte
+    end -- offset after last byte
+    last -- True if range ends with the file
+    """
+    with io.open(path, mode="rb") as file:
+        file.seek(start)
+        text = file.read(end - start).decode("utf-8")
+    try:
+        return list(BibtXt.iter_entries(text, strict=not last))
+    except ValueError:
+        return None
+
+
+def parse_parallel(path, jobs):
+    """Return list of all entries of .bib file parsed by jobs processes.
+
+    path -- path to .bib file
+    jobs -- number of worker processes
+    """
+    shards = min(jobs, os.path.getsize(path) // min_shard_size)
+    if shards <= 1:
+        with io.open(path, encoding="utf-8") as bib:
+            return list(BibtXt.iter_entries(bib))
+    offsets = shard_offsets(path, shards)
+    count = len(offsets) - 1
+    with ProcessPoolExecutor(min(jobs, count), mp_context=pool_context(),
+                             initializer=BibtXt.stop_profiling) as executor:
+        results = list(executor.map(parse_shard, [path] * count,
+                                    offsets[:-1], offsets[1:],
+                                    [False] * (count - 1) + [True]))
+    if any(result is None for result in results):
+        # an entry spans two shards:
+        with io.open(path, encoding="utf-8") as bib:
+            return list(BibtXt.iter_entries(bib))
+    entries = []
+    for result in results:
+        entries.extend(result)
+    return entries
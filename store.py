@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""This module contains the class BibStore.
+
+A store is a SQLite index of a (large, shared) .bib file: every entry is
+kept with its type, fields and parsed authors and editors. Rendering
+against a store only reads the cited keys, so the cost depends on the
+number of citations rather than on the size of the database. Importing a
+changed .bib file again only inserts and deletes the changed entries.
+@string and @preamble entries are kept with key "" (cf. macros()).
+
+Usage: python store.py refs.bib refs.sqlite (import or update)
+"""
+import hashlib
+import io
+import json
+import sqlite3
+import sys
+from collections import Counter
+
+import BibtXt
+from cache import file_digest
+
+store_version = 2
+# maximum number of parameters of a query (cf. SQLITE_MAX_VARIABLE_NUMBER):
+batch_size = 500
+schema = """
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, key TEXT NOT NULL,
+    type TEXT NOT NULL, fields TEXT NOT NULL, authors TEXT NOT NULL,
+    editors TEXT NOT NULL, digest TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS entries_key ON entries (key);
+CREATE INDEX IF NOT EXISTS entries_type ON entries (type);
+"""
+
+
+def dump_names(persons):
+    """Return JSON of parts of names."""
+    return json.dumps([[person.last, person.first, person.von, person.jr]
+                       for person in persons], ensure_ascii=False)
+
+
+def load_names(text):
+    """Return tuple of Person for JSON of dump_names() (None for null)."""
+    parts = json.loads(text)
+    if parts is None:
+        return None
+    return tuple(BibtXt.Person(*person) for person in parts)
+
+
+def stored_names(field_dict, name):
+    """Return JSON of parsed names of field or null if they are not final.
+
+    Names referring to macros or inherited by crossref are parsed after
+    the entry is resolved (cf. BibTeX.resolve()).
+    """
+    value = field_dict.get(name, u"")
+    if BibtXt.macro_mark in value or "crossref" in field_dict:
+        return "null"
+    return dump_names(BibtXt.parse_names(value))
+
+
+class BibStore(object):
+    """Index entries of a .bib file in a SQLite database.
+
+    Instances can be passed to BibTeX (and render() etc.) instead of the
+    content of a .bib file.
+    """
+
+    def __init__(self, path):
+        """Initialize an instance of the class.
+
+        path -- path to SQLite database (created if missing)
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.executescript(schema)
+
+    def meta(self, name):
+        """Return value of name in meta table or None."""
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def update(self, bib_path):
+        """Import .bib file and return (added, removed) number of entries.
+
+        Unchanged entries are kept. Nothing is parsed if the file did not
+        change since the last import.
+
+        bib_path -- path to .bib file
+        """
+        bib_digest = file_digest(bib_path)
+        version = "{}.{}".format(store_version, BibtXt.parser_version)
+        if (self.meta("digest") == bib_digest
+           and self.meta("version") == version):
+            return 0, 0
+        with self.connection:
+            if self.meta("version") != version:
+                # rows of other versions cannot be reused:
+                self.connection.execute("DELETE FROM entries")
+            # old: {(key, digest): [ids]}
+            old = {}
+            for row_id, key, digest in self.connection.execute(
+                    "SELECT id, key, digest FROM entries ORDER BY id"):
+                old.setdefault((key, digest), []).append(row_id)
+            added = 0
+            with io.open(bib_path, encoding="utf-8") as bib:
+                for mytype, key, field_dict in BibtXt.iter_entries(bib):
+                    fields_json = json.dumps(field_dict, ensure_ascii=False,
+                                             sort_keys=True)
+                    digest = hashlib.sha1(u"{}\n{}".format(
+                        mytype, fields_json).encode("utf-8")).hexdigest()
+                    if old.get((key, digest)):
+                        old[(key, digest)].pop()
+                        continue
+                    self.connection.execute(
+                        "INSERT INTO entries (key, type, fields, authors, "
+                        "editors, digest) VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, mytype, fields_json,
+                         stored_names(field_dict, "author"),
+                         stored_names(field_dict, "editor"), digest))
+                    added += 1
+            removed = [row_id for row_ids in old.values()
+                       for row_id in row_ids]
+            for start in range(0, len(removed), batch_size):
+                batch = removed[start:start + batch_size]
+                self.connection.execute(
+                    "DELETE FROM entries WHERE id IN ({})".format(
+                        ", ".join("?" * len(batch))), batch)
+            # entry types are read by every lookup(), so they are kept:
+            types = sorted(row[0] for row in self.connection.execute(
+                "SELECT DISTINCT type FROM entries"))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                [("digest", bib_digest), ("version", version),
+                 ("source", bib_path),
+                 ("types", json.dumps(types, ensure_ascii=False))])
+        return added, len(removed)
+
+    def lookup(self, cited):
+        """Return data of cited keys for BibTeX.read_bib().
+
+        Return (key_count, all_types, entries, names): number of
+        occurrences of cited keys, dict of all entry types of the store,
+        {key: (type, fields)} and {key: (authors, editors)} of cited keys
+        (names are missing if they are parsed after resolving the entry).
+
+        cited -- keys cited in .txt file
+        """
+        key_count = Counter()
+        entries = {}
+        names = {}
+        keys = list(cited)
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            for key, mytype, fields_json, authors, editors in (
+                    self.connection.execute(
+                        "SELECT key, type, fields, authors, editors FROM "
+                        "entries WHERE key IN ({}) ORDER BY id".format(
+                            ", ".join("?" * len(batch))), batch)):
+                key_count[key] += 1
+                if key not in entries:
+                    entries[key] = (mytype, json.loads(fields_json))
+                    if authors != "null" and editors != "null":
+                        names[key] = (load_names(authors),
+                                      load_names(editors))
+        all_types = dict.fromkeys(json.loads(self.meta("types") or "[]"))
+        return key_count, all_types, entries, names
+
+    def macros(self):
+        """Return list of (type, fields) of @string and @preamble entries."""
+        return [(mytype, json.loads(fields_json))
+                for mytype, fields_json in self.connection.execute(
+                    "SELECT type, fields FROM entries WHERE key = '' "
+                    "AND lower(type) IN ('string', 'preamble') "
+                    "ORDER BY id")]
+
+    def close(self):
+        """Close the database."""
+        self.connection.close()
+
+
+def main(argv=None):
+    """Import .bib file into store and return exit status.
+
+    argv -- [path to .bib file, path to store] (default None, i.e.
+    sys.argv[1:])
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2 or not argv[0].endswith(".bib"):
+        sys.stderr.write("Usage: python store.py BIB STORE\n")
+        return 2
+    store = BibStore(argv[1])
+    try:
+        added, removed = store.update(argv[0])
+    except IOError as error:
+        sys.stderr.write("{}: {}\n".format(argv[0], error))
+        return 1
+    finally:
+        store.close()
+    print("{} entries added, {} entries removed.".format(added, removed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""This module contains the watch mode of Bib.tXt.
+
+All pairs of .txt and .bib files are rendered and rendered again whenever
+one of the files changes. Parsed .bib files stay in memory between runs
+and are only parsed again when they change. Changes are detected with
+inotify on Linux (through ctypes) and by polling elsewhere; changes in
+quick succession (e.g. while an editor saves) trigger one rebuild.
+"""
+import ctypes
+import ctypes.util
+import io
+import os
+import select
+import struct
+import sys
+import time
+
+import BibtXt
+
+# inotify events (cf. inotify(7)):
+in_modify = 0x2
+in_close_write = 0x8
+in_moved_to = 0x80
+in_create = 0x100
+event_header = struct.Struct("iIII")
+
+
+class InotifyWatcher(object):
+    """Wait for changes of files using inotify."""
+
+    def __init__(self, paths):
+        """Initialize an instance of the class.
+
+        Raise OSError if inotify is not available.
+
+        paths -- absolute paths of watched files
+        """
+        name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, "inotify_init"):
+            raise OSError("inotify is not available")
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        # directories are watched, since editors often replace files:
+        self.directories = {}
+        directories = {}
+        for path in paths:
+            directory, filename = os.path.split(path)
+            directories.setdefault(directory, set()).add(filename)
+        mask = in_modify | in_close_write | in_moved_to | in_create
+        for directory, filenames in directories.items():
+            wd = libc.inotify_add_watch(self.fd, directory.encode(), mask)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.directories[wd] = (directory, filenames)
+
+    def wait(self, timeout=None):
+        """Return set of changed paths (empty if timeout expired).
+
+        timeout -- seconds (default None, i.e. wait for a change)
+        """
+        changed = set()
+        while not changed:
+            ready = select.select([self.fd], [], [], timeout)[0]
+            if not ready:
+                break
+            data = os.read(self.fd, 1 << 16)
+            pos = 0
+            while pos < len(data):
+                wd, _, _, length = event_header.unpack_from(data, pos)
+                pos += event_header.size
+                filename = data[pos:pos + length].rstrip(b"\0").decode()
+                pos += length
+                directory, filenames = self.directories.get(wd, ("", ()))
+                if filename in filenames:
+                    changed.add(os.path.join(directory, filename))
+        return changed
+
+    def close(self):
+        """Stop watching."""
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Wait for changes of files by comparing their mtime and size."""
+
+    def __init__(self, paths, interval=0.5):
+        """Initialize an instance of the class.
+
+        paths -- absolute paths of watched files
+        interval -- seconds between two checks (default 0.5)
+        """
+        self.interval = interval
+        self.stats = {path: self.stat(path) for path in paths}
+
+    def stat(self, path):
+        """Return (mtime, size) of file or None if it is missing."""
+        try:
+            result = os.stat(path)
+        except OSError:
+            return None
+        return result.st_mtime_ns, result.st_size
+
+    def wait(self, timeout=None):
+        """Return set of changed paths (empty if timeout expired).
+
+        timeout -- seconds (default None, i.e. wait for a change)
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            changed = set()
+            for path, old in self.stats.items():
+                new = self.stat(path)
+                if new != old:
+                    self.stats[path] = new
+                    changed.add(path)
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+            time.sleep(self.interval if deadline is None
+                       else max(0, min(self.interval,
+                                       deadline - time.time())))
+
+    def close(self):
+        """Stop watching."""
+
+
+def make_watcher(paths, interval=0.5):
+    """Return InotifyWatcher or, if not available, PollingWatcher."""
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(paths, interval)
+
+
+def load_bib(bib_path, cache=None):
+    """Return list of parsed entries of .bib file."""
+    with io.open(bib_path, encoding="utf-8") as bib:
+        return BibtXt.parse_entries(bib, cache)
+
+
+def watch(pairs, output_dir=None, title=u"Bibliography", cache=None,
+          style="default", debounce=0.1, interval=0.5):
+    """Render pairs of .txt and .bib files whenever one of them changes.
+
+    Run until interrupted (Ctrl+C). Progress is reported on stderr.
+
+    pairs -- list of (path to .txt file, path to .bib file)
+    output_dir -- directory of output files (default None, i.e. directory
+    of .txt file)
+    title -- title of reference list (default "Bibliography")
+    cache -- instance of cache.BibCache (default None)
+    style -- name of citation style (default "default")
+    debounce -- seconds without changes before rebuilding (default 0.1)
+    interval -- seconds between checks when polling (default 0.5)
+    """
+    pairs = [(os.path.abspath(txt_path), os.path.abspath(bib_path))
+             for txt_path, bib_path in pairs]
+    # parsed .bib files kept in memory:
+    bibs = dict.fromkeys(bib_path for _, bib_path in pairs)
+
+    def build(changed):
+        for bib_path in bibs:
+            if bibs[bib_path] is None or bib_path in changed:
+                try:
+                    bibs[bib_path] = load_bib(bib_path, cache)
+                except (IOError, ValueError) as error:
+                    # e.g. half-written file which is not valid UTF-8:
+                    bibs[bib_path] = None
+                    sys.stderr.write("{}: {}\n".format(bib_path, error))
+        for txt_path, bib_path in pairs:
+            if changed and txt_path not in changed and bib_path not in changed:
+                continue
+            if bibs[bib_path] is None:
+                continue
+            start = time.time()
+            try:
+                with io.open(txt_path, encoding="utf-8") as file:
+                    txt = file.read()
+                content = BibtXt.render(txt, bibs[bib_path], title,
+                                        style=style)
+                with io.open(BibtXt.output_path(txt_path, output_dir),
+                             mode="w", encoding="utf-8") as file:
+                    file.write(content)
+            except (IOError, ValueError) as error:
+                sys.stderr.write("{}: {}\n".format(txt_path, error))
+                continue
+            sys.stderr.write("{}: rendered in {:.0f} ms\n".format(
+                txt_path, (time.time() - start) * 1000))
+
+    watcher = make_watcher(set(path for pair in pairs for path in pair),
+                           interval)
+    try:
+        build(set())
+        while True:
+            changed = watcher.wait()
+            # wait until changes stop:
+            while True:
+                more = watcher.wait(debounce)
+                if not more:
+                    break
+                changed |= more
+            build(changed)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
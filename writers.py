@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""This module contains the writers of output formats of Bib.tXt.
+
+A writer takes the intermediate representation (BibtXt.Document) and a
+writable text stream. Several formats can thus be written from one parse
+and one substitution pass. Further formats can be added with
+register_writer().
+"""
+import html
+import io
+import json
+import re
+
+import BibtXt
+
+# formats: {name: (writer, suffix of output file)}
+formats = {}
+re_markdown = re.compile(r"([\\`*_\[\]<>#])")
+re_blank_line = re.compile(r"\n[ \t]*\n\s*")
+
+
+def register_writer(name, writer, suffix):
+    """Register writer of output format name.
+
+    name -- name of format
+    writer -- function taking Document and writable text stream
+    suffix -- suffix of output files, e.g. "_bibtxt.md"
+    """
+    formats[name] = (writer, suffix)
+
+
+def write_text(document, file):
+    """Write document as plain text (the classic output of Bib.tXt)."""
+    for segment in document.segments:
+        file.write(segment if isinstance(segment, str) else str(segment))
+    file.write(BibtXt.text_bibliography(document.title, document.references,
+                                        document.day))
+
+
+def write_markdown(document, file):
+    """Write document as Markdown.
+
+    The text is kept as it is; citations link to their entries.
+    """
+    for segment in document.segments:
+        if isinstance(segment, str):
+            file.write(segment)
+        else:
+            file.write(u"[{}](#{})".format(
+                re_markdown.sub(r"\\\1", str(segment)), anchor(segment.key)))
+    file.write(u"\n\n## {}\n\n".format(document.title))
+    for reference in document.references:
+        file.write(u"- <a id=\"{}\"></a>{}\n".format(
+            anchor(reference.key), re_markdown.sub(r"\\\1", reference.text)))
+    file.write(u"\n*Generated with Bib.tXt (c) by Max Harder. {}.*\n".format(
+        document.day))
+
+
+def write_html(document, file):
+    """Write document as HTML page; paragraphs are separated by blank lines."""
+    title = html.escape(document.title)
+    file.write(u"<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n"
+               u"<title>{}</title>\n</head>\n<body>\n".format(title))
+    chunks = []
+    for segment in document.segments:
+        if isinstance(segment, str):
+            chunks.append(html.escape(segment))
+        else:
+            chunks.append(u"<cite><a href=\"#{}\">{}</a></cite>".format(
+                anchor(segment.key), html.escape(str(segment))))
+    for paragraph in re_blank_line.split(u"".join(chunks)):
+        if paragraph.strip():
+            file.write(u"<p>{}</p>\n".format(paragraph.strip()))
+    file.write(u"<h2>{}</h2>\n<ul class=\"references\">\n".format(title))
+    for reference in document.references:
+        file.write(u"<li id=\"{}\">{}</li>\n".format(
+            anchor(reference.key), html.escape(reference.text)))
+    file.write(u"</ul>\n<footer>Generated with Bib.tXt (c) by Max Harder. "
+               u"{}.</footer>\n</body>\n</html>\n".format(document.day))
+
+
+def write_json(document, file):
+    """Write document as JSON of converted text, citations and references."""
+    citations = []
+    text = []
+    for segment in document.segments:
+        if isinstance(segment, str):
+            text.append(segment)
+        else:
+            citations.append({"key": segment.key, "prefix": segment.prefix,
+                              "suffix": segment.suffix,
+                              "names": segment.names, "year": segment.year,
+                              "text": str(segment)})
+            text.append(str(segment))
+    references = [{"key": reference.key, "type": reference.entry.type,
+                   "text": reference.text, "fields": reference.entry.fields,
+                   "authors": [str(person) for person
+                               in reference.entry.authors],
+                   "editors": [str(person) for person
+                               in reference.entry.editors]}
+                  for reference in document.references]
+    json.dump({"title": document.title, "text": u"".join(text),
+               "citations": citations, "references": references,
+               "generated": document.day.isoformat()},
+              file, ensure_ascii=False, indent=2)
+    file.write(u"\n")
+
+
+def anchor(key):
+    """Return id of reference-list entry of key."""
+    return u"ref-" + key
+
+
+def write(document, name, output):
+    """Write document in format name to output.
+
+    output -- path to output file or writable text stream
+    """
+    writer = formats[name][0]
+    if hasattr(output, "write"):
+        writer(document, output)
+        return
+    # one buffered handle per output file:
+    with io.open(output, mode="w", encoding="utf-8") as file:
+        writer(document, file)
+
+
+register_writer("text", write_text, "_bibtxt.txt")
+register_writer("markdown", write_markdown, "_bibtxt.md")
+register_writer("html", write_html, "_bibtxt.html")
+register_writer("json", write_json, "_bibtxt.json")